@@ -0,0 +1,207 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from navigation import Navigator
+from layout import generate_grid
+
+
+# the grid sizes (avenues, rows) benchmarked by default, from the hackster.io map's size up to a large warehouse
+SIZES = ((1, 7), (4, 20), (8, 40), (16, 80), (32, 160))
+
+# identifies the format of the result files, and is changed whenever it changes
+FORMAT = 1
+
+
+# the value below which 'p' percent of the sorted list 'values' fall (nearest rank)
+def percentile(values, p):
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+# summarize a list of latencies (seconds) as percentiles in microseconds
+def latency_summary(latencies):
+    values = sorted(latencies)
+    summary = {'count': len(values)}
+    for p in (50, 90, 99):
+        summary['p{}'.format(p)] = percentile(values, p) * 1e6
+    summary['max'] = values[-1] * 1e6
+    summary['mean'] = sum(values) / len(values) * 1e6
+    return summary
+
+
+# generate a grid layout with a cross aisle every 'cross_every' rows
+def grid(avenues, rows, cross_every=4):
+    return generate_grid(avenues, rows, cross_rows=range(0, rows + 1, cross_every))
+
+
+# the worst-case queries: from the states in the corners of the grid to the states furthest away from them,
+# and to states they cannot reach at all (which makes the search visit everything reachable before giving up)
+def worst_case_queries(nav, count):
+    positions = nav.layout.positions
+    xs = [p[0] for p in positions]
+    ys = [p[1] for p in positions]
+    corners = set()
+    for x in (min(xs), max(xs)):
+        for y in (min(ys), max(ys)):
+            corners.update(s for s, p in enumerate(positions) if p == (x, y))
+
+    queries = []
+    per_corner = -(-count // len(corners))
+    for s0 in sorted(corners):
+        costs = nav.costs_from(s0)
+        unreachable = [s for s in range(len(nav.layout)) if s not in costs]
+        furthest = sorted(costs, key=lambda s: -costs[s])
+        queries += [(s0, s) for s in (unreachable + furthest)[:per_corner]]
+    return queries[:count]
+
+
+# time path_to for every (start, end) query, returning the latencies and the total number of states expanded
+def run_queries(nav, queries):
+    latencies = []
+    expanded = 0
+    for s0, s in queries:
+        nav.state = s0
+        t0 = time.perf_counter()
+        nav.path_to(s)
+        latencies.append(time.perf_counter() - t0)
+        expanded += nav.expanded
+    return latencies, expanded
+
+
+# the peak memory allocated (bytes) while calling 'f'
+def peak_memory(f):
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# benchmark the navigation of one grid size
+# the queries only depend on the seed and the grid size, so runs over different lists of sizes can still be compared
+def benchmark_size(avenues, rows, queries, worst, repeats, seed):
+    rng = random.Random('{}-{}x{}'.format(seed, avenues, rows))
+    layout = grid(avenues, rows)
+    result = {
+        'avenues': avenues,
+        'rows': rows,
+        'states': len(layout),
+        'layout_transitions': len(layout.transitions),
+    }
+
+    # constructing the navigator generates the inverse transitions and builds the graph
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        nav = Navigator(layout.state('start'), layout)
+        times.append(time.perf_counter() - t0)
+    result['transitions'] = len(nav.transitions)
+    result['init'] = latency_summary(times)
+    result['init_peak_bytes'] = peak_memory(lambda: Navigator(layout.state('start'), layout))
+
+    # listing the transitions out of every state
+    times = []
+    for s in range(len(layout)):
+        t0 = time.perf_counter()
+        nav.possible_transitions(s)
+        times.append(time.perf_counter() - t0)
+    result['possible_transitions'] = latency_summary(times)
+
+    # random and worst-case route searches (the memory is measured in a separate run, since tracing slows everything down)
+    n = len(layout)
+    random_queries = [(rng.randrange(n), rng.randrange(n)) for _ in range(queries)]
+    worst_queries = worst_case_queries(nav, worst)
+    for name, qs in (('random', random_queries), ('worst_case', worst_queries)):
+        latencies, expanded = run_queries(nav, qs)
+        result[name] = latency_summary(latencies)
+        result[name]['expanded_mean'] = expanded / len(qs)
+        result[name]['peak_bytes'] = peak_memory(lambda: run_queries(nav, qs))
+    return result
+
+
+# print the results as a table
+def print_results(results):
+    print('{:>9} {:>7} {:>8} | {:>9} | {:>9} {:>9} {:>9} {:>9} | {:>9} {:>9} {:>9} | {:>8}'.format(
+        'grid', 'states', 'trans', 'init ms', 'rnd p50', 'rnd p90', 'rnd p99', 'expanded', 'worst p50', 'worst p99', 'expanded', 'peak KB'))
+    for r in results:
+        print('{:>9} {:>7} {:>8} | {:9.2f} | {:9.1f} {:9.1f} {:9.1f} {:9.0f} | {:9.1f} {:9.1f} {:9.0f} | {:8.0f}'.format(
+            '{}x{}'.format(r['avenues'], r['rows']), r['states'], r['transitions'], r['init']['p50'] / 1000,
+            r['random']['p50'], r['random']['p90'], r['random']['p99'], r['random']['expanded_mean'],
+            r['worst_case']['p50'], r['worst_case']['p99'], r['worst_case']['expanded_mean'],
+            max(r['random']['peak_bytes'], r['worst_case']['peak_bytes']) / 1024))
+    print('(latencies in microseconds unless noted)')
+
+
+# print the ratio of each result to the same measurement in a baseline result file (above 1 is slower or bigger)
+def print_comparison(results, settings, baseline):
+    old = dict(((r['avenues'], r['rows']), r) for r in baseline['results'])
+    print('compared to {} ({})'.format(baseline.get('label') or 'baseline', baseline.get('time')))
+    if (baseline['seed'], baseline['queries'], baseline['worst']) != (settings['seed'], settings['queries'], settings['worst']):
+        print('warning: the baseline ran different queries (seed {seed}, {queries} random and {worst} worst-case queries)'.format(**baseline))
+    for r in results:
+        b = old.get((r['avenues'], r['rows']))
+        if b is None:
+            continue
+        ratios = []
+        for section, key in (('init', 'p50'), ('random', 'p50'), ('random', 'p99'), ('random', 'expanded_mean'),
+                             ('worst_case', 'p50'), ('worst_case', 'expanded_mean'), ('worst_case', 'peak_bytes')):
+            if b[section][key]:
+                ratios.append('{} {} {:.2f}x'.format(section, key, r[section][key] / b[section][key]))
+        print('{}x{}: {}'.format(r['avenues'], r['rows'], ', '.join(ratios)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark route planning on grid layouts of increasing size')
+    parser.add_argument('--sizes', help='comma separated AVENUESxROWS grid sizes (default: {})'.format(
+        ','.join('{}x{}'.format(a, r) for a, r in SIZES)))
+    parser.add_argument('--queries', type=int, default=1000, help='random route queries per grid size')
+    parser.add_argument('--worst', type=int, default=50, help='worst-case route queries per grid size')
+    parser.add_argument('--repeats', type=int, default=5, help='navigator constructions timed per grid size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', help='name of this run (such as the version being measured)')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare the results to')
+    args = parser.parse_args()
+
+    sizes = SIZES
+    if args.sizes:
+        sizes = [tuple(int(x) for x in size.split('x')) for size in args.sizes.split(',')]
+
+    results = []
+    for avenues, rows in sizes:
+        results.append(benchmark_size(avenues, rows, args.queries, args.worst, args.repeats, args.seed))
+        print('benchmarked {}x{}'.format(avenues, rows), file=sys.stderr)
+
+    print_results(results)
+
+    settings = {
+        'format': FORMAT,
+        'label': args.label,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'seed': args.seed,
+        'queries': args.queries,
+        'worst': args.worst,
+    }
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, settings, json.load(f))
+
+    if args.output:
+        settings['results'] = results
+        with open(args.output, 'w') as f:
+            json.dump(settings, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
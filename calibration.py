@@ -0,0 +1,36 @@
+import os
+import json
+
+
+# the ID of the current boot of the system (None if it is not available)
+# motor position counters are reset on boot, so calibrations based on them are only valid within the same boot
+def boot_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+# stores the robot's calibration in a JSON file so it can be reused after a restart
+class CalibrationStore:
+    def __init__(self, path):
+        self.path = path
+
+    # read the stored calibration, returns None if there is none (or it cannot be read)
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    # write the calibration, replacing the file in one step so a crash never leaves a half-written file
+    def save(self, calibration):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(calibration, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print('Could not save calibration: {}'.format(e))
@@ -0,0 +1,126 @@
+import os
+
+
+# runs a control loop at a fixed tick rate, and measures how late each tick starts (jitter)
+#
+# usage:
+#   loop.start()
+#   while running:
+#       loop.wait()
+#       ... read sensors, update motors ...
+class ControlLoop:
+    def __init__(self, clock, rate=100):
+        self.clock = clock
+        self.set_rate(rate)
+        self.reset_stats()
+
+    # change the tick rate (ticks per second), taking effect from the next tick
+    def set_rate(self, rate):
+        self.rate = rate
+        self.period = 1 / rate
+
+    # clear the jitter measurements
+    def reset_stats(self):
+        self.ticks = 0
+        self.overruns = 0
+        self.jitter_total = 0
+        self.jitter_max = 0
+
+    # schedule the first tick for now
+    def start(self):
+        self.next_tick = self.clock.time()
+
+    # wait until the next tick is due
+    def wait(self):
+        now = self.clock.time()
+        if now < self.next_tick:
+            self.clock.sleep(self.next_tick - now)
+            now = self.clock.time()
+
+        # how late this tick started
+        jitter = max(0, now - self.next_tick)
+        self.ticks += 1
+        self.jitter_total += jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+
+        # if the loop fell more than a whole period behind, start again from now instead of running ticks back to back to catch up
+        self.next_tick += self.period
+        if now > self.next_tick:
+            self.overruns += 1
+            self.next_tick = now + self.period
+
+    # a summary of the jitter measurements
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'jitter_mean': self.jitter_total / self.ticks if self.ticks else 0,
+            'jitter_max': self.jitter_max,
+        }
+
+
+# reads the green and blue channels of an ev3dev2 ColorSensor (in RGB-RAW mode) straight from its sysfs value files
+# the files are kept open, so each read is a single system call instead of going through the ev3dev2 attribute machinery
+# the readings are scaled by the white balance the same way as ColorSensor.rgb
+class SysfsColorReader:
+    def __init__(self, sensor):
+        self.sensor = sensor
+        self.fd_green = os.open(os.path.join(sensor._path, 'value1'), os.O_RDONLY)
+        self.fd_blue = os.open(os.path.join(sensor._path, 'value2'), os.O_RDONLY)
+        self.update_calibration()
+
+    # take the white balance from the sensor (call after ColorSensor.calibrate_white)
+    def update_calibration(self):
+        self.green_scale = 255 / self.sensor.green_max
+        self.blue_scale = 255 / self.sensor.blue_max
+
+    # read the (green, blue) channels
+    def read(self):
+        g = int(os.pread(self.fd_green, 16, 0))
+        b = int(os.pread(self.fd_blue, 16, 0))
+        return min(int(g * self.green_scale), 255), min(int(b * self.blue_scale), 255)
+
+    def close(self):
+        os.close(self.fd_green)
+        os.close(self.fd_blue)
+
+
+# reads the green and blue channels through ColorSensor.rgb, for sensors without sysfs files (such as the simulated one)
+class ColorReader:
+    def __init__(self, sensor):
+        self.sensor = sensor
+
+    def update_calibration(self):
+        pass
+
+    def read(self):
+        _, g, b = self.sensor.rgb
+        return g, b
+
+    def close(self):
+        pass
+
+
+# sends speed commands to a motor only when the speed actually changes, saving a sysfs write on every unchanged tick
+class MotorWriter:
+    def __init__(self, motor):
+        self.motor = motor
+        self.speed = None
+        self.writes = 0
+
+    # run the motor at 'speed' percent
+    def set(self, speed):
+        if speed != self.speed:
+            self.motor.on(speed)
+            self.speed = speed
+            self.writes += 1
+
+    # stop the motor
+    def off(self, brake=True):
+        self.motor.off(brake=brake)
+        self.speed = None
+
+    # forget the last speed (call after commanding the motor directly, such as with on_for_rotations)
+    def reset(self):
+        self.speed = None
@@ -0,0 +1,284 @@
+import heapq
+from math import ceil
+
+
+# the timed route planned for one robot
+# 'steps' is a list of (t, state, transition) with the tick each state is reached at, and the transition used to reach it
+# (None for the start, and for ticks spent waiting)
+class FleetPlan:
+    def __init__(self, robot, steps):
+        self.robot = robot
+        self.steps = steps
+
+    # the tick the robot arrives at its goal
+    @property
+    def arrival(self):
+        return self.steps[-1][0]
+
+    # the state the robot is at (or has last reached) at tick 't'
+    def state_at(self, t):
+        s = self.steps[0][1]
+        for t0, s0, _ in self.steps:
+            if t0 > t:
+                break
+            s = s0
+        return s
+
+
+# plans collision-free routes for several robots sharing a layout, using cooperative A*
+#
+# time is split into ticks of 'tick' seconds, and each transition takes its cost rounded up to whole ticks
+# robots are planned one at a time in priority order, each one avoiding the places and times reserved by the robots before it:
+#  - an intersection (all the states at the same grid position) holds one robot at a time, including while it turns
+#  - the line between two intersections holds one robot at a time in either direction, so robots never meet head-on in a single-lane avenue
+#  - a robot that reached its goal stays parked there until its next route is planned
+# a robot can wait at an intersection for a tick when its way is reserved
+#
+# a stream of jobs can be planned by calling plan_robot() for each job in order of start time, starting each robot's next job
+# where and when its last one ended; a job that cannot be planned yet can be tried again with a later start time
+class FleetPlanner:
+    def __init__(self, nav, tick=0.5):
+        self.nav = nav
+        self.tick = tick
+        self._build()
+        self.reset()
+
+    # index the places, lines and transitions of the layout
+    def _build(self):
+        # states at the same position are the same physical place (each state is its own place without positions)
+        # places and lines are numbered, so the reservation keys are cheap to hash
+        positions = self.nav.layout.positions
+        if positions is None or None in positions:
+            positions = range(len(self.nav.layout))
+        numbers = {}
+        self._places_of = [numbers.setdefault(p, len(numbers)) for p in positions]
+        self.place = self._places_of.__getitem__
+        lines = {}
+
+        # the transitions from each state as (transition, next state, ticks, line), where the line is None for turns on the spot
+        self._outgoing = {}
+        self._incoming = {}
+        self._lines_of = {}
+        for t in self.nav.transitions:
+            ticks = max(1, int(ceil(t.cost() / self.tick - 1e-9)))
+            a, b = self.place(t.s0), self.place(t.s)
+            line = None
+            if a != b:
+                line = lines.setdefault((min(a, b), max(a, b)), len(numbers) + len(lines))
+            self._outgoing.setdefault(t.s0, []).append((t, t.s, ticks, line))
+            self._lines_of[id(t)] = line
+            self._incoming.setdefault(t.s, []).append((t.s0, ticks))
+
+        # the distances (in ticks) to each goal searched so far, used as the A* heuristic
+        self._distances = {}
+        self._version = self.nav.version
+
+    # clear all reservations
+    def reset(self):
+        self._reserved = {}    # (place or line, t) -> robot
+        self._parked = {}      # place -> (t, robot) for robots parked at their goal from tick t on
+        self._parked_at = {}   # robot -> the place it is parked at
+        self._last_use = {}    # place -> the last tick it is reserved at
+
+    # drop the reservations before tick 't' (when planning a stream of jobs, all later jobs start at or after 't')
+    def forget(self, t):
+        self._reserved = dict((key, robot) for key, robot in self._reserved.items() if key[1] >= t)
+
+    # plan routes for a list of (start, goal) pairs, in priority order (the first robot has the highest priority)
+    # if a robot cannot be planned, planning starts over (up to 'attempts' times) with the robot moved ahead of the others,
+    # or with the robot still standing at its goal moved ahead of it
+    # returns a list with a FleetPlan for each robot (None for robots that could still not be planned)
+    def plan(self, robots, attempts=3, horizon=None):
+        # a robot whose goal is another robot's start has to wait for that robot to leave, so plan that robot first
+        starts = dict((self.place(start), i) for i, (start, _) in enumerate(robots))
+        order = []
+        for i in range(len(robots)):
+            chain = []
+            while i is not None and i not in order and i not in chain:
+                chain.append(i)
+                i = starts.get(self.place(robots[i][1]))
+            order.extend(reversed(chain))
+        for _ in range(attempts):
+            self.reset()
+            plans = [None] * len(robots)
+
+            # every robot stays parked at its start until its route is planned
+            for i in order:
+                self._parked[self.place(robots[i][0])] = (0, i)
+                self._parked_at[i] = self.place(robots[i][0])
+
+            failed = None
+            for i in order:
+                start, goal = robots[i]
+                plans[i] = self.plan_robot(i, start, goal, horizon=horizon)
+                if plans[i] is None and failed is None:
+                    failed = i
+                    blocker = self._parked.get(self.place(goal), (None, None))[1]
+
+            if failed is None:
+                return plans
+
+            # give the robot that failed (or the one in its way) a higher priority, and try again
+            if blocker is not None and blocker != failed and order.index(blocker) > order.index(failed):
+                order.remove(blocker)
+                order.insert(order.index(failed), blocker)
+            elif order[0] != failed:
+                order.remove(failed)
+                order.insert(0, failed)
+            else:
+                break
+        return plans
+
+    # plan a route for one robot from 'start' (at tick 'start_time') to 'goal' that avoids all current reservations, and reserve it
+    # the robot leaves the place it was parked at by its last plan, and parks at 'goal'
+    # returns the FleetPlan, or None if there is no such route within 'horizon' extra ticks of waiting and detours
+    # (or within 'max_expansions' search steps)
+    def plan_robot(self, robot, start, goal, start_time=0, horizon=None, max_expansions=20000):
+        # rebuild the index if the layout or the transition costs changed since it was built
+        if self._version != self.nav.version:
+            self._build()
+
+        # another robot is parked at the goal until its own next route is planned
+        parked = self._parked.get(self.place(goal))
+        if parked is not None and parked[1] != robot:
+            return None
+
+        h = self._distances_to(goal)
+        if start not in h or not self._reachable(start, goal, robot):
+            return None
+
+        # the robot cannot stop at the goal before the last tick someone else passes through it
+        free_from = self._last_use.get(self.place(goal), -1)
+
+        if horizon is None:
+            horizon = 2 * h[start] + 50
+        end_time = max(start_time + h[start], free_from) + horizon
+
+        # the robot is no longer parked once it leaves (but it still is if no route is found)
+        parked_place = self._parked_at.pop(robot, None)
+        parked = self._parked.pop(parked_place, None)
+
+        plan = self._search(robot, start, goal, start_time, end_time, free_from, h, max_expansions)
+        if plan is not None:
+            self._reserve(plan)
+        elif parked is not None:
+            self._parked[parked_place] = parked
+            self._parked_at[robot] = parked_place
+        return plan
+
+    # A* over (state, tick)
+    # the heuristic is the static distance to the goal, but never earlier than the goal is free for good
+    # ties are broken towards states closer to the goal and then later ticks, so the search heads straight for the goal instead of
+    # spreading out over every state it could wait at
+    def _search(self, robot, start, goal, start_time, end_time, free_from, h, max_expansions):
+        reserved = self._reserved
+        parked = self._parked
+        places_of = self._places_of
+        outgoing = self._outgoing
+
+        heap = [(max(start_time + h[start], free_from), h[start], -start_time, start)]
+        parent = {(start, start_time): None}
+        closed = set()
+        while heap and len(closed) < max_expansions:
+            _, _, t, s = heapq.heappop(heap)
+            t = -t
+            if (s, t) in closed:
+                continue
+            closed.add((s, t))
+
+            if s == goal and t >= free_from:
+                steps = []
+                node = (s, t)
+                while node is not None:
+                    previous, transition = parent[node] or (None, None)
+                    steps.append((node[1], node[0], transition))
+                    node = previous
+                steps.reverse()
+                return FleetPlan(robot, steps)
+
+            if t >= end_time:
+                continue
+
+            # wait a tick at the current state, or take a transition
+            p0 = places_of[s]
+            next_nodes = []
+            if reserved.get((p0, t + 1), robot) == robot:
+                next_nodes.append((s, t + 1, None))
+
+            for tr, s1, d, line in outgoing.get(s, ()):
+                if s1 not in h:
+                    continue
+                if line is None:
+                    # turning on the spot keeps the intersection for the whole turn
+                    keys = [(p0, k) for k in range(t + 1, t + d + 1)]
+                else:
+                    keys = [(line, k) for k in range(t, t + d)]
+                    keys.append((places_of[s1], t + d))
+                    if places_of[s1] in parked:
+                        continue
+                for key in keys:
+                    if reserved.get(key, robot) != robot:
+                        break
+                else:
+                    next_nodes.append((s1, t + d, tr))
+
+            for s1, t1, tr in next_nodes:
+                if (s1, t1) not in parent:
+                    parent[(s1, t1)] = ((s, t), tr)
+                    heapq.heappush(heap, (max(t1 + h[s1], free_from), h[s1], -t1, s1))
+        return None
+
+    # whether 'goal' can be reached from 'start' without passing through places where other robots are parked
+    def _reachable(self, start, goal, robot):
+        parked = self._parked
+        seen = set([start])
+        stack = [start]
+        while stack:
+            s = stack.pop()
+            if s == goal:
+                return True
+            for _, s1, _, line in self._outgoing.get(s, ()):
+                if s1 not in seen and (line is None or parked.get(self._places_of[s1], (0, robot))[1] == robot):
+                    seen.add(s1)
+                    stack.append(s1)
+        return False
+
+    # the distance in ticks from every state to 'goal' (searched backwards from the goal)
+    def _distances_to(self, goal):
+        distances = self._distances.get(goal)
+        if distances is None:
+            distances = {}
+            heap = [(0, goal)]
+            while heap:
+                d, s = heapq.heappop(heap)
+                if s in distances:
+                    continue
+                distances[s] = d
+                for s0, ticks in self._incoming.get(s, ()):
+                    if s0 not in distances:
+                        heapq.heappush(heap, (d + ticks, s0))
+            self._distances[goal] = distances
+        return distances
+
+    def _reserve_place(self, place, t, robot):
+        self._reserved[(place, t)] = robot
+        if t > self._last_use.get(place, -1):
+            self._last_use[place] = t
+
+    # reserve the places and lines used by a plan, and park the robot at its goal
+    def _reserve(self, plan):
+        robot = plan.robot
+        t0, s0, _ = plan.steps[0]
+        self._reserve_place(self.place(s0), t0, robot)
+        for t, s, tr in plan.steps[1:]:
+            line = self._lines_of[id(tr)] if tr is not None else None
+            if line is not None:
+                for k in range(t0, t):
+                    self._reserved[(line, k)] = robot
+            else:
+                for k in range(t0 + 1, t + 1):
+                    self._reserve_place(self.place(s0), k, robot)
+            self._reserve_place(self.place(s), t, robot)
+            t0, s0 = t, s
+        self._parked[self.place(s0)] = (t0, robot)
+        self._parked_at[robot] = self.place(s0)
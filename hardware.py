@@ -0,0 +1,34 @@
+import time
+
+from control import SysfsColorReader
+
+
+# the motors, sensors and LEDs of the real EV3 robot
+# the motion code only uses the attributes below, so a simulated robot (see sim.py) can provide the same interface
+class EV3Hardware:
+    def __init__(self):
+        # import the required libraries to interface with the EV3 hardware components
+        # (imported here so the rest of the code can run without ev3dev2 installed)
+        from ev3dev2.motor import LargeMotor, MediumMotor
+        from ev3dev2.sensor.lego import ColorSensor, InfraredSensor
+        from ev3dev2.led import Leds
+
+        # the real robot runs on the system clock
+        self.clock = time
+
+        self.leds = Leds()
+        self.motor_left = LargeMotor(address='outA')
+        self.motor_right = LargeMotor(address='outD')
+        self.motor_lift = MediumMotor(address='outC')
+
+        # the color sensor for following the line
+        self.sensor_color = ColorSensor()
+        self.sensor_color.mode = self.sensor_color.MODE_RGB_RAW
+
+        # the IR sensor for finding the home position of the lift
+        self.sensor_infrared = InfraredSensor()
+        self.sensor_infrared.mode = self.sensor_infrared.MODE_IR_PROX
+
+    # a fast reader for the green and blue channels of the color sensor (created after the sensor is calibrated)
+    def color_reader(self):
+        return SysfsColorReader(self.sensor_color)
@@ -0,0 +1,136 @@
+import threading
+from collections import deque
+
+
+# raised inside the motion code when the job being executed has been cancelled
+class JobCancelled(Exception):
+    pass
+
+
+# a single command for the robot to execute ('pickup', 'drop' or 'move' from state 'src' to state 'dst')
+class Job:
+    # the states a job goes through
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    CANCELLED = 'cancelled'
+    FAILED = 'failed'
+
+    def __init__(self, job_id, job_type, src, dst, item=None):
+        self.id = job_id
+        self.type = job_type
+        self.src = src
+        self.dst = dst
+
+        # the item of the pallet a drop puts down (if known), for keeping track of what is stored where
+        self.item = item
+        self.status = Job.QUEUED
+        self.cancelled = False
+
+        # fraction of the job's route completed so far (0-1)
+        self.progress = 0
+
+        # the route planned for the job in advance (a list of Actions), or None to plan it when the job starts
+        self.actions = None
+
+        # for a step of a sequence: the ID of the sequence, the index of the step, and the number of steps
+        self.sequence = None
+        self.step = None
+        self.steps = None
+
+    # a JSON-friendly summary of the job for status reports
+    def summary(self):
+        summary = {'id': self.id, 'type': self.type, 'status': self.status, 'progress': round(self.progress, 2)}
+        if self.sequence is not None:
+            summary.update(sequence=self.sequence, step=self.step, steps=self.steps)
+        return summary
+
+
+# a thread-safe queue of jobs waiting to be executed by the robot's worker thread
+class JobQueue:
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._pending = deque()
+        self._next_id = 1
+
+        # the job the worker is executing right now (None when idle)
+        self.current = None
+
+    # add a job to the end of the queue and return it
+    # a 'move' directly following another queued 'move' is coalesced into it, so the robot drives a single route to the final destination
+    def put(self, job_type, src, dst, item=None):
+        with self._lock:
+            if job_type == 'move' and self._pending and self._pending[-1].type == 'move' and self._pending[-1].sequence is None:
+                job = self._pending[-1]
+                job.dst = dst
+                return job
+
+            job = Job(self._next_id, job_type, src, dst, item)
+            self._next_id += 1
+            self._pending.append(job)
+            self._lock.notify()
+            return job
+
+    # add the steps of a sequence to the end of the queue as one job each, without coalescing any of them
+    # 'steps' is a list of (type, src, dst, actions, item) with the route of each step planned in advance
+    # returns the list of jobs (the sequence ID is the ID of the first job)
+    def put_sequence(self, steps):
+        with self._lock:
+            jobs = []
+            for i, (job_type, src, dst, actions, item) in enumerate(steps):
+                job = Job(self._next_id, job_type, src, dst, item)
+                self._next_id += 1
+                job.actions = actions
+                job.sequence = jobs[0].id if jobs else job.id
+                job.step = i
+                job.steps = len(steps)
+                jobs.append(job)
+            self._pending.extend(jobs)
+            self._lock.notify()
+            return jobs
+
+    # wait for the next job, mark it as running and return it
+    # if 'block' is False, None is returned instead of waiting when the queue is empty
+    def get(self, block=True):
+        with self._lock:
+            while not self._pending:
+                if not block:
+                    return None
+                self._lock.wait()
+            job = self._pending.popleft()
+            job.status = Job.RUNNING
+            self.current = job
+            return job
+
+    # mark the current job as finished with a final status
+    def finish(self, job, status):
+        with self._lock:
+            job.status = status
+            if self.current is job:
+                self.current = None
+
+    # cancel the job with 'job_id', or every queued and running job if no ID is given
+    # if 'sequence' is given, only the jobs of that sequence are cancelled
+    # returns the list of cancelled jobs
+    def cancel(self, job_id=None, sequence=None):
+        with self._lock:
+            cancelled = []
+            for job in list(self._pending):
+                if (job_id is None or job.id == job_id) and (sequence is None or job.sequence == sequence):
+                    self._pending.remove(job)
+                    job.cancelled = True
+                    job.status = Job.CANCELLED
+                    cancelled.append(job)
+
+            # the running job stops the next time the motion code checks for cancellation
+            job = self.current
+            if job is not None and (job_id is None or job.id == job_id) and (sequence is None or job.sequence == sequence):
+                job.cancelled = True
+                cancelled.append(job)
+            return cancelled
+
+    # summaries of the running and queued jobs
+    def summary(self):
+        with self._lock:
+            jobs = ([self.current] if self.current is not None else []) + list(self._pending)
+            return [job.summary() for job in jobs]
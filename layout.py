@@ -0,0 +1,152 @@
+import json
+
+from navigation import Layout, Transition, ActionType
+
+
+# the four directions the robot can face at an intersection, in clockwise order
+HEADINGS = ['n', 'e', 's', 'w']
+
+# grid offset of the neighboring intersection in each direction
+OFFSETS = {'n': (0, 1), 'e': (1, 0), 's': (0, -1), 'w': (-1, 0)}
+
+
+# load a layout from a JSON file
+#
+# the file either lists the transitions explicitly:
+#   {
+#       "states": ["start", "ave1_1_w", ...],                 (optional, fixes the state IDs in this order)
+#       "transitions": [["start", "ave1_1_w", "forward"],
+#                       ["ave1_0_w", "ave1_0_s", "left", false], ...],
+#       "aliases": {"slot_1": "ave1_2_w", ...},               (optional)
+#       "positions": {"ave1_2_w": [0, 2], ...}                (optional)
+#   }
+# or describes a grid to generate with the same arguments as generate_grid():
+#   {"grid": {"avenues": 4, "rows": 20, "one_way": [["ave1_0_w", "ave1_0_s"]]}}
+def load_layout(path):
+    with open(path) as f:
+        data = json.load(f)
+
+    if 'grid' in data:
+        return generate_grid(**data['grid'])
+    return parse_layout(data)
+
+
+# build a layout from the explicit format described in load_layout()
+def parse_layout(data):
+    names = list(data.get('states', []))
+    index = {name: s for s, name in enumerate(names)}
+
+    # look up the ID of a state, creating the state if it has not been listed yet
+    def state_id(name):
+        s = index.get(name)
+        if s is None:
+            s = index[name] = len(names)
+            names.append(name)
+        return s
+
+    transitions = []
+    for t in data['transitions']:
+        invertible = t[3] if len(t) > 3 else True
+        transitions.append(Transition(state_id(t[0]), state_id(t[1]), ActionType[t[2]], invertible=invertible))
+
+    positions = None
+    if 'positions' in data:
+        positions = [None] * len(names)
+        for name, pos in data['positions'].items():
+            positions[index[name]] = tuple(pos)
+
+    return Layout(names, transitions, aliases=data.get('aliases', {}), positions=positions)
+
+
+# generate a grid layout of parallel avenues running north, joined by cross aisles
+#
+# 'avenues' is the number of avenues, and 'rows' is the number of intersections along each avenue above row 0
+# 'cross_rows' are the rows where a cross aisle joins each avenue to its neighbors (row 0 by default)
+# every other row has a pallet slot on each side listed in 'slot_sides'
+# each avenue has a station below row 0, and the stations of the first and last avenue are named 'slot_out' and 'slot_in'
+# 'one_way' lists (from, to) pairs of state names that can only be traveled in that direction, such as
+# ('ave1_0_w', 'ave1_0_s') when the line at a corner is too short for the color sensor to detect when turning back
+#
+# states are named like the 'State' enum (ave<avenue>_<row>_<heading>), slots are numbered along each avenue,
+# west before east, and the robot starts at 'start' (row 0 of the first avenue, facing north)
+def generate_grid(avenues=1, rows=7, cross_rows=(0,), slot_sides=('w', 'e'), one_way=()):
+    cross_rows = set(cross_rows)
+
+    # the lines leaving each intersection, and whether each line leads to another intersection (otherwise it is a dead end)
+    def lines(a, r):
+        ls = {}
+        if r < rows:
+            ls['n'] = True
+        ls['s'] = r > 0
+        if r in cross_rows:
+            if a < avenues:
+                ls['e'] = True
+            if a > 1:
+                ls['w'] = True
+        else:
+            for side in slot_sides:
+                ls[side] = False
+        return ls
+
+    names = []
+    positions = []
+    index = {}
+    node_lines = {}
+
+    # create a state for every direction the robot can face at each intersection:
+    # facing along any of its lines, or facing away from a neighbor it arrived from
+    for a in range(1, avenues + 1):
+        for r in range(rows + 1):
+            ls = lines(a, r)
+            node_lines[a, r] = ls
+            headings = set(ls)
+            for h, travel in ls.items():
+                if travel:
+                    headings.add(HEADINGS[(HEADINGS.index(h) + 2) % 4])
+
+            for h in HEADINGS:
+                if h in headings:
+                    name = 'ave{}_{}_{}'.format(a, r, h)
+                    index[name] = len(names)
+                    names.append(name)
+                    positions.append((a - 1, r))
+
+    transitions = []
+    for (a, r), ls in node_lines.items():
+        for h in HEADINGS:
+            s0 = index.get('ave{}_{}_{}'.format(a, r, h))
+            if s0 is None:
+                continue
+
+            # driving forward along a line reaches the neighboring intersection facing the same way
+            if ls.get(h):
+                dx, dy = OFFSETS[h]
+                s = index['ave{}_{}_{}'.format(a + dx, r + dy, h)]
+                transitions.append(Transition(s0, s, ActionType.forward, invertible=False))
+
+            # turning stops on the next line in the turning direction
+            i = HEADINGS.index(h)
+            for action, step in ((ActionType.right, 1), (ActionType.left, -1)):
+                for k in range(1, 4):
+                    h1 = HEADINGS[(i + step * k) % 4]
+                    if h1 in ls:
+                        transitions.append(Transition(s0, index['ave{}_{}_{}'.format(a, r, h1)], action, invertible=False))
+                        break
+
+    # drop the reverse direction of the one-way transitions
+    if one_way:
+        reverse = set((index[s], index[s0]) for s0, s in one_way)
+        transitions = [t for t in transitions if (t.s0, t.s) not in reverse]
+
+    # human-readable names for the slots and stations
+    aliases = {'start': 'ave1_0_n', 'slot_out': 'ave1_0_s', 'slot_in': 'ave{}_0_s'.format(avenues)}
+    slot = 1
+    for a in range(1, avenues + 1):
+        aliases['station_{}'.format(a)] = 'ave{}_0_s'.format(a)
+        for r in range(1, rows + 1):
+            for h in ('w', 'e'):
+                if node_lines[a, r].get(h) is False:
+                    aliases['slot_{}'.format(slot)] = 'ave{}_{}_{}'.format(a, r, h)
+                    slot += 1
+
+    return Layout(names, transitions, aliases=aliases, positions=positions)
@@ -1,81 +1,54 @@
-import time
 import json
-from math import *
+import threading
 
 # import the navigation functions for the robot
 from navigation import *
 
+# import the motion control and job execution behaviors of the robot
+from motion import Driver
+
+# import the job statuses reported to the Alexa device
+from jobs import Job
+
+# import the interface to the EV3 hardware components
+from hardware import EV3Hardware
+
+# import the slot assignment for pallets dropped without a location
+from slotting import Slotting
+
 # import the Alexa Gadgets Toolkit so the robot can communicate with an Alexa device
 from agt import AlexaGadget
 
-# import the required libraries to interface with the EV3 hardware components
-from ev3dev2.motor import LargeMotor, MediumMotor
-from ev3dev2.sensor.lego import ColorSensor, InfraredSensor
-from ev3dev2.led import Leds
 
+# main class that handles all of the robot behaviors controlled through the Alexa Skill
+# (Driver comes first so AlexaGadget's own initialization is not passed the Driver's arguments)
+class Robot(Driver, AlexaGadget):
+    def __init__(self):
+        AlexaGadget.__init__(self)
 
-# a basic class to handle PID control behavior
-class PID:
-    kp, kd = 0, 0
-    e0 = 0
+        # set up the motors and sensors, and calibrate them
+        nav = Navigator(State.start)
 
-    def __init__(self, kp=0, kd=0):
-        self.kp = kp
-        self.kd = kd
+        # the layout never changes while running, so look routes up in a precomputed table (loaded from disk if it was already built for this layout)
+        nav.enable_route_table('routes.cache')
 
-    def calculate(self, e):
-        v = self.kp * e + (e - self.e0) * self.kd
-        self.e0 = e
-        return v
+        Driver.__init__(self, EV3Hardware(), nav, calibration_path='calibration.json')
 
+        # keep the control loop trace of each job for diagnosing the line follower,
+        # and use the line follower parameters tune.py found from earlier traces (if it has been run)
+        self.trace_dir = 'traces'
+        self.load_tuning('tuning.json')
 
-# an enum to define the state of the lifter
-class LiftState(IntEnum):
-    up = 0
-    down = 1
+        # write the timing histograms to a metrics file every 10 seconds
+        self.metrics.start_writer('metrics.prom', interval=10)
 
+        # keep track of the stored pallets so a drop can be given the best free slot (kept on disk so it survives a restart)
+        self.slotting = Slotting(nav, path='slots.json')
+        self.slots_lock = threading.Lock()
 
-# main class that handles all of the robot behaviors controlled through the Alexa Skill
-class Robot(AlexaGadget):
-    def __init__(self):
-        super().__init__()
-
-        # initialize all of the motors
-        print('Initializing devices')
-        self.leds = Leds()
-        self.motor_left = LargeMotor(address='outA')
-        self.motor_right = LargeMotor(address='outD')
-        self.motor_lift = MediumMotor(address='outC')
-        self.motor_left.off(brake=False)
-        self.motor_right.off(brake=False)
-        self.motor_lift.off(brake=False)
-
-        # rotate the robot ~45 degrees off the path so the color sensor has a white background for calibration
-        turn_distance = 0.75
-        self.motor_left.on_for_rotations(20, turn_distance, block=False)
-        self.motor_right.on_for_rotations(20, -turn_distance)
-
-        # initialize the color sensor for following the line
-        self.sensor_color = ColorSensor()
-        self.sensor_color.mode = self.sensor_color.MODE_RGB_RAW
-        self.sensor_color.calibrate_white()
-
-        # rotate the robot back to its original position before calibrating the color sensor
-        self.motor_left.on_for_rotations(20, -turn_distance, block=False)
-        self.motor_right.on_for_rotations(20, turn_distance)
-
-        # initialize the IR sensor for finding the home position of the lift
-        self.sensor_infrared = InfraredSensor()
-        self.sensor_infrared.mode = self.sensor_infrared.MODE_IR_PROX
-
-        # run the lift calibration routine so the robot knows where the lifter is on startup
-        print('Calibrating lift')
-        self.calibrate_lift()
-
-        # setup the navigation controlled and the line-following PID controller
-        print('Initializing navigation')
-        self.nav = Navigator(State.start)
-        self.line_PID = PID(kp=1.5, kd=2)
+        # start the worker thread that executes the commands received from the Alexa Skill
+        self.worker = threading.Thread(target=self.run_jobs, daemon=True)
+        self.worker.start()
 
     # called when the EV3 brick connects to an Alexa device
     def on_connected(self, device_addr):
@@ -90,218 +63,164 @@ class Robot(AlexaGadget):
         print("{} disconnected from Echo device".format(self.friendly_name))
 
     # the function called to receive gadget control directives from the Alexa Skill through the connected Alexa device
+    # the directive is only validated and queued here, so the gadget connection stays responsive while the robot is moving
     def on_custom_mindstorms_gadget_control(self, directive):
+        start_time = self.clock.time()
+
         # decode the directive payload into a JSON object
-        payload = json.loads(directive.payload.decode("utf-8"))
+        with self.metrics.span('directive_decode_seconds'):
+            payload = json.loads(directive.payload.decode("utf-8"))
         print("Control payload: {}".format(payload))
 
         # determine which command to be executed
         control_type = payload['type']
-        if control_type == 'pickup':
-            # get the source and destination states for this command
-            src_state = State[payload['state']]
-            dst_state = State[payload['location']]
-
-            # raise the lift if the robot needs to move
-            if not dst_state == src_state:
-                self.set_lift(LiftState.up)
-
-            # set the robot's current state to the state passed from the Alexa skill so the robot can be commanded even after the program is restarted.
-            # (Alexa skill has persistent storage of all the state information for crates and the robot)
-            self.nav.state = src_state
-
-            # use the navigation system to follow a path to the destination.
-            self.move_to(dst_state)
-
-            # this routine follows the line slowly to pickup a pallet in front of it
-            self.set_lift(LiftState.down)
-            self.move_forward(speed=0.2)
-            self.set_lift(LiftState.up)
-            self.move_back(speed=0.2)
-
-        elif control_type == 'drop':
-            # get the source and destination states for this command
-            src_state = State[payload['state']]
-            dst_state = State[payload['location']]
+        try:
+            self.handle_directive(control_type, payload)
+        finally:
+            self.metrics.observe('directive_seconds', self.clock.time() - start_time, type=control_type)
+
+    # execute or queue a decoded directive
+    def handle_directive(self, control_type, payload):
+        if control_type == 'cancel':
+            # cancel a specific job, or everything if no job ID is given
+            for job in self.jobs.cancel(payload.get('id')):
+                # the running job ends when the motion code notices, queued jobs end here
+                if job.status == Job.CANCELLED:
+                    self.job_ended(job)
+                self.report(job)
+            return
 
-            # set the robot's current state to the state passed from the Alexa skill so the robot can be commanded even after the program is restarted.
-            self.nav.state = src_state
+        elif control_type == 'status':
+            # report the running and queued jobs
+            self.send_custom_event('Custom.Mindstorms.Gadget', 'Status', {'jobs': self.jobs.summary()})
+            return
 
-            # make sure the lift is raised before navigating to the destination state
-            self.set_lift(LiftState.up)
-            self.move_to(dst_state)
+        elif control_type == 'sequence':
+            with self.slots_lock:
+                self.handle_sequence(payload)
+            return
 
-            # this routine follows the line slowly, lowers the lift, then backs up to the starting point
-            self.move_forward(speed=0.2)
-            self.set_lift(LiftState.down)
-            self.move_back(speed=0.2)
-            self.set_lift(LiftState.up)
+        elif control_type not in ('pickup', 'drop', 'move'):
+            print('Unknown control type: {}'.format(control_type))
+            return
 
-        elif control_type == 'move':
+        # the slots are chosen and reserved under the lock, so a job ending on the worker thread does not change them in between
+        with self.slots_lock:
             # get the source and destination states for this command
-            src_state = State[payload['state']]
-            dst_state = State[payload['location']]
-
-            # make sure the lift is raised before navigating to the destination state
-            self.set_lift(LiftState.up)
-
-            # execute a basic move command
-            self.nav.state = src_state
-            self.move_to(dst_state)
+            try:
+                src_state = self.nav.layout.state(payload['state'])
+                dst_state = self.destination(control_type, payload)
+            except KeyError as e:
+                print('Invalid state in directive: {}'.format(e))
+                return
+            if dst_state is None:
+                print('No free slot to drop the pallet in')
+                return
+
+            # a job that can never get to its destination is not queued (blocked routes can still fail when the job runs)
+            if not self.nav.reachability.reachable(src_state, dst_state):
+                print('No route from {} to {}'.format(self.nav.layout.name(src_state), self.nav.layout.name(dst_state)))
+                return
+
+            # queue the command for the worker thread (consecutive moves are merged into one route)
+            job = self.jobs.put(control_type, src_state, dst_state, payload.get('item'))
+            self.reserve_slot(job)
+            self.report(job)
+
+    # the destination state of a pickup, drop or move operation
+    # a drop to the 'auto' location goes to the best free slot for the pallet's item (None if every slot is full)
+    def destination(self, control_type, operation):
+        if control_type == 'drop' and operation['location'] == 'auto':
+            return self.slotting.best_slot(operation.get('item'))
+        return self.nav.layout.state(operation['location'])
+
+    # keep the slot occupancy and the pick counts of the items up to date
+    def update_slots(self, control_type, dst_state, item):
+        if dst_state in self.slotting.slots:
+            if control_type == 'pickup':
+                self.slotting.remove(dst_state)
+            elif control_type == 'drop':
+                self.slotting.store(dst_state, item)
+
+    # hold the slot a queued drop is going to, so no other drop is given it before this one is done
+    def reserve_slot(self, job):
+        if job.type == 'drop' and job.dst in self.slotting.slots:
+            self.slotting.reserved.add(job.dst)
+
+    # the occupancy only changes once a pickup or drop is done (and is saved then), and a drop's slot is no longer reserved once
+    # it has ended either way
+    def job_ended(self, job):
+        with self.slots_lock:
+            if job.type == 'drop':
+                self.slotting.reserved.discard(job.dst)
+            if job.status == Job.DONE and job.type in ('pickup', 'drop'):
+                self.update_slots(job.type, job.dst, job.item)
+                self.slotting.save()
+
+    # validate and plan a sequence of operations, then queue them to run back to back
+    # the payload has the robot's 'state' and a list of 'operations' (each with a 'type', a 'location' and optionally an 'item'),
+    # and each operation starts where the one before it ended
+    # nothing is queued unless every operation is valid and every route can be planned
+    def handle_sequence(self, payload):
+        operations = payload.get('operations')
+        if not operations:
+            print('Empty sequence')
+            return
 
-    # a high-level movement command to navigate the robot on a path to a desired state
-    def move_to(self, state):
-        # generate the set of actions required to navigate from the current state to the destination state
-        actions = self.nav.path_to(state)
+        try:
+            state = self.nav.layout.state(payload['state'])
+        except KeyError as e:
+            print('Invalid state in directive: {}'.format(e))
+            return
 
-        # if there is no valid path, or the robot is already at the destination state, the command has been completed
-        if actions is None:
+        # the occupancy is only updated as the steps are done, so the operations are planned against the occupancy as it will be
+        # after the steps before them, which is put back afterwards
+        contents = dict(self.slotting.contents)
+        picks = dict(self.slotting.picks)
+        steps = []
+        try:
+            for i, operation in enumerate(operations):
+                control_type = operation['type']
+                if control_type not in ('pickup', 'drop', 'move'):
+                    raise ValueError('unknown operation type {}'.format(control_type))
+
+                dst_state = self.destination(control_type, operation)
+                if dst_state is None:
+                    raise ValueError('no free slot to drop the pallet in')
+                self.update_slots(control_type, dst_state, operation.get('item'))
+
+                actions = self.nav.path_to(dst_state, state)
+                if actions is None:
+                    raise ValueError('no route from {} to {}'.format(self.nav.layout.name(state), self.nav.layout.name(dst_state)))
+                steps.append((control_type, state, dst_state, actions, operation.get('item')))
+                state = dst_state
+        except (KeyError, TypeError, ValueError) as e:
+            # the operation's index is reported so the skill can tell the user which one was wrong
+            print('Invalid sequence operation {}: {}'.format(i, e))
+            self.send_custom_event('Custom.Mindstorms.Gadget', 'SequenceRejected', {'step': i, 'error': str(e)})
+            return
+        finally:
+            self.slotting.contents = contents
+            self.slotting.picks = picks
+
+        for job in self.jobs.put_sequence(steps):
+            self.reserve_slot(job)
+            self.report(job)
+
+    # send a status update for a job to the Alexa device (with the name of its destination, which may have been chosen by the robot)
+    # the steps of a sequence only send a compact event when they are queued, start and finish, rather than one per action as well
+    def report(self, job):
+        Driver.report(self, job)
+        if job.sequence is not None:
+            if job.status != Job.RUNNING or job.progress == 0:
+                self.send_custom_event('Custom.Mindstorms.Gadget', 'SequenceStep', {
+                    'sequence': job.sequence, 'step': job.step, 'steps': job.steps, 'status': job.status,
+                    'location': self.nav.layout.name(job.dst)})
             return
 
-        # loop through and run the required actions in order
-        for a in actions:
-            print(a.action_type.name, a.n)
-
-            # check what type the action is, then run the necessary command to perform the action
-            # a.n represents the number of times an action will be repeated... ActionType.forward and n=2 would mean move forward two times
-            if a.action_type == ActionType.forward:
-                self.move_forward(num=a.n)
-            elif a.action_type == ActionType.left:
-                self.move_turn(num=a.n, right=False)
-            elif a.action_type == ActionType.right:
-                self.move_turn(num=a.n, right=True)
-
-        # set the robot's current state to the destination state for good measure
-        self.nav.state = state
-
-    # this function executes a forward movement command
-    # 'num' represents how many intersections to pass through
-    # 'speed' represents how fast to move 0-1
-    def move_forward(self, num=1, speed=0.3):
-        in_intersection = False
-
-        # loop through repeated moves until there are no more moves to execute
-        while num > 0:
-            # get the green and blue channels of the color sensor for line-following
-            # there is just enough space between the green and blue sensors to detect both sides of the line
-            _, g, b = self.sensor_color.rgb
-
-            # if the robot is not in an intersection, and both channels are dark, the robot must be in an intersection.
-            if not in_intersection and g < 110 and b < 110:
-                print('hit intersection')
-                in_intersection = True
-                # decrease the number of remaining moves
-                num -= 1
-            elif in_intersection and g > 110 and b > 110:
-                # if the robot was in an intersection, but both channels are now light, the robot has left the intersection
-                in_intersection = False
-            else:
-                # find the difference in brightness between the left and right sides of the line
-                line_dif = (g - b) / 1000
-
-                # determine the amount to steer based on the PID controller
-                steering = self.line_PID.calculate(line_dif)
-
-                # generate the speeds for each motor based on the forward speed, and the steering amount
-                left = -min(max(-1, speed + steering), 1)
-                right = -min(max(-1, speed - steering), 1)
-                self.motor_left.on(round(left * 100))
-                self.motor_right.on(round(right * 100))
-
-        # the loop will exit immediately when the robot exits the intersection
-        # the robot needs to "roll past" the intersection a small amount so the wheels are more in-line with the grid
-        # (the color sensor is a couple cm in front of the axle line)
-        roll_past = -0.65
-        self.motor_left.on_for_rotations(round(speed * 100),
-                                         roll_past,
-                                         block=False)
-        self.motor_right.on_for_rotations(round(speed * 100), roll_past)
-
-    # this function executes a turns
-    # 'num' represents how many paths to turn past at an intersection
-    # 'right' represents direction to turn (True = turn right, False = turn left)
-    # 'speed' represents the speed to turn the robot at
-    def move_turn(self, num=1, right=True, speed=0.2):
-        # repeat the command in a loop so consecutive turns are run smoothly
-        while num > 0:
-            # the state variable for a single turn movement
-            state = 0
-            while True:
-                # get the green and blue channels of the color sensor for line-detection
-                _, g, b = self.sensor_color.rgb
-
-                # choose the outside channel to detect passing over the line
-                light_value = g if right else b
-
-                # beginning of the turn (robot was centered on the line and the outside color channel should get darker as it passes over the line)
-                if state == 0:
-                    # when the outside color channel goes high, the robot has turned past the first line, and now needs to detect when another line appears
-                    if light_value > 220:
-                        state = 1
-
-                # the robot is between two lines and waiting until it turns onto the next line
-                elif state == 1:
-                    # the color channel which was previously light, has now gone dark, meaning the robot has completed one turn
-                    if light_value < 180:
-                        # decrease the number of remaining turns, and repeat the process again
-                        num -= 1
-                        break
-
-                # tell motors to move in opposite directions at the desired speed
-                speed_scalar = 1 if right else -1
-                self.motor_left.on(round(-speed_scalar * speed * 100))
-                self.motor_right.on(round(speed_scalar * speed * 100))
-
-        # turn off the motors at the end of the set of turns so there is no annoying high-frequency humming
-        self.motor_left.off()
-        self.motor_right.off()
-
-    # move the robot straight back at a certain speed for a certain number of rotations
-    def move_back(self, speed=0.2, distance=1.6):
-        self.motor_left.on_for_rotations(round(speed * 100),
-                                         distance,
-                                         block=False)
-        self.motor_right.on_for_rotations(round(speed * 100), distance)
-
-    # lift calibration procedure
-    def calibrate_lift(self):
-        # set the lift motor to move up at 10% speed
-        self.motor_lift.on(-10)
-
-        # wait until the IR sensor detects the forklift in front of it
-        while self.sensor_infrared.proximity >= 70:
-            pass
-
-        # set the robot's internal lift-state to 'up'
-        self.lift_state = LiftState.up
-
-        # lower the lift
-        self.set_lift(LiftState.down)
-
-    # a controlled function to ensure proper lift control (don't allow raising it even more if the lift is already up...)
-    def set_lift(self, state):
-        # ensure the lift is not already in the desired position
-        if state != self.lift_state:
-            if state == LiftState.up:
-                # if the lift needs to be raised, turn the motor just the right amount
-                self.motor_lift.on_for_rotations(10, -0.5)
-                # DO NOT turn off the motor because it is probably holding some weight on the forklift
-            elif state == LiftState.down:
-                # if the lift needs to be lowered, turn the motor just the right amount to be just above the ground
-                self.motor_lift.on_for_rotations(10, 0.5)
-                # turn off the motor to reduce annoying buzzing
-                self.motor_lift.off()
-
-            # set the robot's internal lift state for safe control
-            self.lift_state = state
-
-    # turn off all motors and lights
-    def poweroff(self):
-        self.motor_left.off(brake=False)
-        self.motor_right.off(brake=False)
-        self.motor_lift.off(brake=False)
-        self.leds.set_color('LEFT', 'BLACK')
-        self.leds.set_color('RIGHT', 'BLACK')
+        summary = job.summary()
+        summary['location'] = self.nav.layout.name(job.dst)
+        self.send_custom_event('Custom.Mindstorms.Gadget', 'JobStatus', summary)
 
 
 # called at program startup
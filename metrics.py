@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+
+# the default histogram bucket upper bounds in seconds, from decoding a directive (well under a millisecond) to a whole job (minutes)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+
+
+# a histogram of observed values with fixed buckets, like a Prometheus histogram
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# times the code inside a 'with' block and adds the time to a histogram of a Metrics object
+class Span:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = self.metrics.clock.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, self.metrics.clock.time() - self.start, **self.labels)
+
+
+# a thread-safe collection of timing histograms, written to a file in the Prometheus text format
+#
+# usage:
+#   with metrics.span('route_planning_seconds', job='pickup'):
+#       ... plan the route ...
+#
+# each name and set of labels has its own histogram, and every name is prefixed with 'prefix' in the file
+# times are measured on 'clock' (the time module, or the simulator's virtual clock)
+class Metrics:
+    def __init__(self, clock=time, prefix='warehousebot_'):
+        self.clock = clock
+        self.prefix = prefix
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._writer = None
+
+    # a context manager timing its block into the histogram for 'name' and 'labels'
+    def span(self, name, **labels):
+        return Span(self, name, labels)
+
+    # add a value to the histogram for 'name' and 'labels'
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    # the histograms in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        with self._lock:
+            last_name = None
+            for (name, labels), h in sorted(self.histograms.items()):
+                name = self.prefix + name
+                if name != last_name:
+                    lines.append('# TYPE {} histogram'.format(name))
+                    last_name = name
+
+                # the bucket counts are cumulative, ending with the total count in the '+Inf' bucket
+                total = 0
+                for bound, count in zip(h.buckets + ('+Inf',), h.counts):
+                    total += count
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', bound),)), total))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), h.sum))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), h.count))
+        return '\n'.join(lines) + '\n'
+
+    # write the histograms to 'path', replacing the file atomically so a scraper never reads a partial file
+    def write(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    # write the histograms to 'path' every 'interval' seconds (of wall time) from a background thread
+    def start_writer(self, path, interval=10):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write(path)
+                except OSError as e:
+                    print('Could not write metrics: {}'.format(e))
+
+        self._writer = threading.Thread(target=run, daemon=True)
+        self._writer.start()
+
+
+# format a tuple of (name, value) label pairs as {name="value",...}
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+
+# decorate a Driver method so each call is timed into the histogram for 'name' and 'labels',
+# labelled with the type of the job being executed as well
+def timed(name, **labels):
+    def decorate(f):
+        @wraps(f)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.span(name, job=self.job_type(), **labels):
+                return f(self, *args, **kwargs)
+        return wrapper
+    return decorate
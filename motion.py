@@ -0,0 +1,724 @@
+import os
+
+# import the navigation functions for the robot
+from navigation import *
+
+# import the job queue used to execute commands in the background
+from jobs import Job, JobQueue, JobCancelled
+
+# import the fixed-rate control loop used by the line follower
+from control import ControlLoop, MotorWriter
+
+# import the trace buffer that records the control loop
+from telemetry import TraceBuffer, FLAG_FORWARD, FLAG_INTERSECTION, FLAG_LINE, FLAG_MISSED, FLAG_PHANTOM
+
+# import the odometry that tells the line follower when the next intersection is due
+from odometry import Odometry
+
+# import the calibration store used to skip the calibration routines on restart
+from calibration import CalibrationStore, boot_id
+
+# import the timing histograms of the jobs and motion primitives
+from metrics import Metrics, timed
+
+
+# a basic class to handle PID control behavior
+class PID:
+    kp, kd = 0, 0
+    e0 = 0
+
+    def __init__(self, kp=0, kd=0):
+        self.kp = kp
+        self.kd = kd
+
+    # 'ticks' is the time since the last calculation in ticks of the loop the gains were tuned at,
+    # so the derivative term stays the same when the loop runs slower
+    def calculate(self, e, ticks=1):
+        v = self.kp * e + (e - self.e0) / ticks * self.kd
+        self.e0 = e
+        return v
+
+
+# an enum to define the state of the lifter
+class LiftState(IntEnum):
+    up = 0
+    down = 1
+
+
+# a lift movement that was started without waiting for it to finish, so the robot can drive in the meantime
+# the motor runs to its target position on its own, so nothing has to watch it until the movement is waited for, but the
+# motion loops poll it now and then (see poll) so the time it finished at is known even when nobody was waiting for it
+class LiftMove:
+    # the degrees the lift motor turns between the lift's up and down positions, and how close to its target it has to get
+    TRAVEL = 180
+    TOLERANCE = 20
+
+    # how often (in seconds) the motion loops check whether the movement has finished
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, driver, state):
+        self.driver = driver
+        self.state = state
+        self.start_position = driver.motor_lift.position
+        self.target = self.start_position + (-self.TRAVEL if state == LiftState.up else self.TRAVEL)
+        self.start_time = driver.clock.time()
+        self.job_type = driver.job_type()
+        self.finished = False
+
+        # when the lift was first seen at its position (None until then), when it was last checked, and when it was first waited for
+        self.end_time = None
+        self.polled = self.start_time
+        self.wait_time = None
+
+    # the fraction (0-1) of the movement completed so far
+    def progress(self):
+        return min(1, abs(self.driver.motor_lift.position - self.start_position) / self.TRAVEL)
+
+    # whether the lift has reached its position
+    def done(self):
+        if self.end_time is None:
+            motor = self.driver.motor_lift
+            if not motor.is_running and abs(motor.position - self.target) < self.TOLERANCE:
+                self.end_time = self.driver.clock.time()
+        return self.end_time is not None
+
+    # check whether the movement has finished, at most every POLL_INTERVAL seconds (reading the motor is not free)
+    def poll(self):
+        now = self.driver.clock.time()
+        if self.end_time is None and now - self.polled >= self.POLL_INTERVAL:
+            self.polled = now
+            self.done()
+
+    # wait until the lift has covered 'fraction' of the movement (all of it by default)
+    # raises an exception if it takes more than 'timeout' seconds from the first wait, such as when the lift is stuck
+    # (the movement is then given up, so the next one can start)
+    def wait(self, fraction=1, timeout=5):
+        clock = self.driver.clock
+        if self.wait_time is None:
+            self.wait_time = clock.time()
+        while not self.done() and (fraction >= 1 or self.progress() < fraction):
+            if clock.time() - self.wait_time > timeout:
+                self.abandon()
+                raise Exception('Lift did not reach the {} position'.format(self.state.name))
+            clock.sleep(0.01)
+
+        if fraction >= 1 and not self.finished:
+            self.finished = True
+            if self.state == LiftState.down:
+                # turn off the motor to reduce annoying buzzing
+                self.driver.motor_lift.off()
+            # the time the lift took to get there, not including any driving after it finished
+            self.driver.metrics.observe('lift_seconds', self.end_time - self.start_time, direction=self.state.name, job=self.job_type)
+
+    # stop the motor of a movement that did not finish, and take the lift to be in whichever position it got closer to
+    def abandon(self):
+        driver = self.driver
+        driver.motor_lift.off()
+        if driver.lift_move is self:
+            driver.lift_move = None
+        if self.progress() < 0.5:
+            driver.lift_state = LiftState.down if self.state == LiftState.up else LiftState.up
+
+
+# the motion and job execution behaviors of the robot, independent of how it receives its commands
+# 'hardware' provides the motors, sensors, LEDs and clock (EV3Hardware for the real robot, or SimHardware from sim.py)
+# 'nav' is the Navigator to plan routes with (the map on the hackster.io project if not given)
+# 'calibration_path' is the file to keep the sensor and lift calibration in, so it can be reused after a restart
+class Driver:
+    def __init__(self, hardware, nav=None, calibration_path=None):
+        # initialize all of the motors
+        print('Initializing devices')
+        self.hardware = hardware
+        self.clock = hardware.clock
+        self.leds = hardware.leds
+        self.motor_left = hardware.motor_left
+        self.motor_right = hardware.motor_right
+        self.motor_lift = hardware.motor_lift
+        self.sensor_color = hardware.sensor_color
+        self.sensor_infrared = hardware.sensor_infrared
+        self.motor_left.off(brake=False)
+        self.motor_right.off(brake=False)
+        self.motor_lift.off(brake=False)
+
+        # the queue of jobs for the robot to execute
+        self.jobs = JobQueue()
+
+        # the lift movement still in progress (a LiftMove, see set_lift), and whether the lift is carrying a pallet
+        self.lift_move = None
+        self.carrying = False
+
+        # time the jobs, route planning and motion primitives on the robot's clock
+        self.metrics = Metrics(self.clock)
+
+        # calibrate the color sensor and the lift (reusing the stored calibration if it still checks out)
+        self.calibrate(calibration_path)
+        self.color_reader = hardware.color_reader()
+
+        # setup the navigation controlled and the line-following PID controller
+        print('Initializing navigation')
+        self.nav = nav if nav is not None else Navigator(State.start)
+        self.line_PID = PID(kp=1.5, kd=2)
+
+        # the level both color channels drop below at an intersection, and the levels the outside channel rises above and then
+        # drops below while turning onto the next line (tune.py finds better values from recorded traces, see load_tuning)
+        self.intersection_threshold = 110
+        self.turn_thresholds = (220, 180)
+
+        # the line follower runs at a fixed rate, and only sends speeds to the drive motors when they change
+        # the rate drops to 'cruise_rate' in the middle of segments whose length the odometry has learned, and is back up to
+        # 'control_rate' by the time the next intersection is due
+        self.control_rate = 100
+        self.cruise_rate = 40
+        self.control_loop = ControlLoop(self.clock, rate=self.control_rate)
+        self.odometry = Odometry(self.motor_left, self.motor_right, self.nav.layout.positions)
+        self.drive_left = MotorWriter(self.motor_left)
+        self.drive_right = MotorWriter(self.motor_right)
+
+        # forward runs through several intersections speed up to 'cruise_speed', changing speed by at most 'ramp_rate' per second
+        self.cruise_speed = 0.45
+        self.ramp_rate = 0.5
+
+        # the fraction of the lift's travel after which a pallet being picked up is clear of the floor, so the robot can back up
+        self.pallet_clear = 0.5
+
+        # every control loop tick is recorded, and the trace of each job is written to 'trace_dir' (if set) when it finishes
+        self.trace = TraceBuffer()
+        self.trace_dir = None
+
+    # use the line follower parameters found by tune.py, stored in the JSON file at 'path'
+    # returns False (keeping the current parameters) if there is no such file
+    def load_tuning(self, path):
+        tuning = CalibrationStore(path).load()
+        if not tuning:
+            return False
+
+        self.line_PID = PID(kp=tuning.get('kp', self.line_PID.kp), kd=tuning.get('kd', self.line_PID.kd))
+        self.cruise_speed = tuning.get('cruise_speed', self.cruise_speed)
+        self.intersection_threshold = tuning.get('intersection_threshold', self.intersection_threshold)
+        self.turn_thresholds = tuple(tuning.get('turn_thresholds', self.turn_thresholds))
+        return True
+
+    # the type of the job being executed ('none' when idle, such as during calibration), to label the metrics with
+    def job_type(self):
+        job = self.jobs.current
+        return job.type if job is not None else 'none'
+
+    # report a status update for a job
+    def report(self, job):
+        print('Job {id} ({type}): {status} {progress}'.format(**job.summary()))
+
+    # the worker thread that executes queued jobs one at a time
+    def run_jobs(self):
+        while True:
+            self.execute(self.jobs.get())
+
+    # execute the queued jobs until the queue is empty (for running without a worker thread, such as in simulation)
+    def run_queued(self):
+        while True:
+            job = self.jobs.get(block=False)
+            if job is None:
+                return
+            self.execute(job)
+
+    # execute a job taken from the queue, and report its final status
+    def execute(self, job):
+        self.report(job)
+        start_time = self.clock.time()
+
+        try:
+            self.run_job(job)
+            status = Job.DONE
+        except JobCancelled:
+            # stop where the robot is, the skill will send the robot's state with the next command
+            self.drive_left.off()
+            self.drive_right.off()
+            status = Job.CANCELLED
+        except Exception as e:
+            print('Job {} failed: {}'.format(job.id, e))
+            self.drive_left.off()
+            self.drive_right.off()
+            status = Job.FAILED
+
+        self.metrics.observe('job_seconds', self.clock.time() - start_time, type=job.type, status=status)
+        self.jobs.finish(job, status)
+        self.job_ended(job)
+        self.report(job)
+        self.dump_trace(job)
+
+        # the later steps of a sequence start where this one should have ended, so they cannot run if it did not complete
+        if status != Job.DONE and job.sequence is not None:
+            for other in self.jobs.cancel(sequence=job.sequence):
+                if other.status == Job.CANCELLED:
+                    self.job_ended(other)
+                self.report(other)
+
+    # called once a job has its final status (done, cancelled or failed), including queued jobs cancelled before they ran
+    # (the Robot keeps track of the stored pallets here)
+    def job_ended(self, job):
+        pass
+
+    # write the control loop trace recorded during a job to a file, and start a new trace
+    def dump_trace(self, job):
+        if self.trace_dir is not None:
+            try:
+                os.makedirs(self.trace_dir, exist_ok=True)
+                self.trace.dump(os.path.join(self.trace_dir, 'job-{}.trace'.format(job.id)))
+            except OSError as e:
+                print('Could not save trace: {}'.format(e))
+        self.trace.clear()
+
+    # execute the motion for a single job
+    def run_job(self, job):
+        src_state = job.src
+        dst_state = job.dst
+
+        if job.type == 'pickup':
+            # raise the lift if the robot needs to move (the empty lift rises while the robot drives off)
+            if not dst_state == src_state:
+                self.set_lift(LiftState.up, block=False)
+
+            # set the robot's current state to the state passed from the Alexa skill so the robot can be commanded even after the program is restarted.
+            # (Alexa skill has persistent storage of all the state information for crates and the robot)
+            self.nav.state = src_state
+
+            # use the navigation system to follow a path to the destination.
+            self.move_to(dst_state, job.actions)
+
+            # this routine follows the line slowly to pickup a pallet in front of it
+            # the lift has to be all the way down before driving into the pallet, and the robot only backs up once the pallet is
+            # lifted clear of the floor (the lift finishes rising on the way back)
+            self.set_lift(LiftState.down)
+            self.move_forward(speed=0.2)
+            self.set_lift(LiftState.up, block=False)
+            self.carrying = True
+            self.lift_move.wait(self.pallet_clear)
+            self.move_back(speed=0.2)
+
+        elif job.type == 'drop':
+            # set the robot's current state to the state passed from the Alexa skill so the robot can be commanded even after the program is restarted.
+            self.nav.state = src_state
+
+            # make sure the lift is raised before navigating to the destination state
+            self.set_lift(LiftState.up)
+            self.move_to(dst_state, job.actions)
+
+            # this routine follows the line slowly, lowers the lift all the way to put the pallet down, then backs up to the starting point
+            # (the empty lift rises while the robot drives off to its next job)
+            self.move_forward(speed=0.2)
+            self.set_lift(LiftState.down)
+            self.carrying = False
+            self.move_back(speed=0.2)
+            self.set_lift(LiftState.up, block=False)
+
+        elif job.type == 'move':
+            # make sure the lift is raised before navigating to the destination state (it rises while the robot drives off, unless it carries a pallet)
+            self.set_lift(LiftState.up, block=False)
+
+            # execute a basic move command
+            self.nav.state = src_state
+            self.move_to(dst_state, job.actions)
+
+    # raise JobCancelled if the job being executed has been cancelled (called regularly by the motion code)
+    def check_cancelled(self):
+        job = self.jobs.current
+        if job is not None and job.cancelled:
+            raise JobCancelled()
+
+    # a high-level movement command to navigate the robot on a path to a desired state
+    # 'actions' is the path if it was already planned (such as for the steps of a sequence)
+    def move_to(self, state, actions=None):
+        # a pallet would drag on the floor, so the lift has to be all the way up before the robot drives off with one
+        if self.carrying:
+            self.wait_lift()
+
+        # generate the set of actions required to navigate from the current state to the destination state
+        if actions is None:
+            with self.metrics.span('route_planning_seconds', job=self.job_type()):
+                actions = self.nav.path_to(state)
+
+        # if there is no valid path the job fails (if the robot is already at the destination state, there are no actions to run)
+        if actions is None:
+            raise Exception('No route from {} to {}'.format(self.nav.layout.name(self.nav.state), self.nav.layout.name(state)))
+
+        # loop through and run the required actions in order
+        job = self.jobs.current
+        for i, a in enumerate(actions):
+            self.check_cancelled()
+            print(a.action_type.name, a.n)
+            start_time = self.clock.time()
+
+            # every action except the last one blends into the next action without stopping the robot
+            blend = i < len(actions) - 1
+
+            # check what type the action is, then run the necessary command to perform the action
+            # a.n represents the number of times an action will be repeated... ActionType.forward and n=2 would mean move forward two times
+            if a.action_type == ActionType.forward:
+                self.move_forward(num=a.n, blend=blend, transitions=a.transitions)
+            elif a.action_type == ActionType.left:
+                self.move_turn(num=a.n, right=False, blend=blend)
+            elif a.action_type == ActionType.right:
+                self.move_turn(num=a.n, right=True, blend=blend)
+
+            # record how long the action took so future routes are planned on the measured travel times
+            self.nav.record(a, self.clock.time() - start_time)
+
+            # report the progress along the route
+            if job is not None:
+                job.progress = (i + 1) / len(actions)
+                self.report(job)
+
+        # set the robot's current state to the destination state for good measure
+        self.nav.state = state
+
+    # this function executes a forward movement command
+    # 'num' represents how many intersections to pass through
+    # 'speed' represents how fast to move 0-1 (runs through more than one intersection speed up to 'cruise_speed' in between)
+    # 'blend' leaves the motors running at the end so the next action can start without stopping
+    # 'transitions' are the transitions to the intersections passed (if known), so the odometry can tell when each one is due
+    @timed('motion_seconds', primitive='forward')
+    def move_forward(self, num=1, speed=0.3, blend=False, transitions=None):
+        threshold = self.intersection_threshold
+        in_intersection = False
+
+        # ramp up to the cruise speed on runs through several intersections, and back down to 'speed' before the last one
+        ramp = num > 1 and self.cruise_speed > speed
+        v = speed
+
+        # the segment up to the next intersection: where it started, its key and expected distance (None if not known), and
+        # whether a phantom was found on it (so its distance is not learned)
+        odometry = self.odometry
+        segment = 0
+        segment_start = odometry.position()
+        key = self.segment_key(transitions, segment)
+        expected = odometry.expected(key)
+        in_phantom = suspect = False
+        phantoms = 0
+
+        # loop through repeated moves until there are no more moves to execute
+        self.control_loop.start()
+        while num > 0:
+            self.check_cancelled()
+            self.poll_lift()
+
+            # poll slower in the middle of the segment, and at the full rate once the next intersection could be near
+            distance = odometry.position() - segment_start
+            self.control_loop.set_rate(self.cruise_rate if odometry.is_early(expected, distance) else self.control_rate)
+            self.control_loop.wait()
+
+            # get the green and blue channels of the color sensor for line-following
+            # there is just enough space between the green and blue sensors to detect both sides of the line
+            g, b = self.color_reader.read()
+            flags = FLAG_FORWARD
+            line_dif = steering = 0
+            dark = g < threshold and b < threshold
+
+            # both channels dark long before the next intersection is due is a mark on the floor, and is followed over like the line
+            # a second one in the same move is more likely a real intersection the learned distance is wrong about, so the distance
+            # is forgotten and the intersection counted
+            if not in_intersection and dark and not in_phantom and phantoms > 0 and odometry.is_early(expected, distance):
+                odometry.forget(key)
+                expected = None
+            if not in_intersection and dark and odometry.is_early(expected, distance):
+                if not in_phantom:
+                    phantoms += 1
+                    print('ignored phantom intersection')
+                    odometry.phantoms += 1
+                    in_phantom = suspect = True
+                flags |= FLAG_PHANTOM
+                dark = False
+            elif not dark:
+                in_phantom = False
+
+            # if the robot is not in an intersection, and both channels are dark, the robot must be in an intersection.
+            if not in_intersection and dark:
+                print('hit intersection')
+                in_intersection = True
+                flags |= FLAG_INTERSECTION
+                # decrease the number of remaining moves
+                num -= 1
+
+                # learn the distance of the segment, and start the next one here
+                if key is not None:
+                    if suspect:
+                        odometry.suspect(key)
+                    else:
+                        odometry.record(key, distance)
+                segment += 1
+                segment_start += distance
+                key = self.segment_key(transitions, segment)
+                expected = odometry.expected(key)
+                suspect = False
+            elif in_intersection and g > threshold and b > threshold:
+                # if the robot was in an intersection, but both channels are now light, the robot has left the intersection
+                in_intersection = False
+            else:
+                # the intersection should have been found by now, so it was missed: count it, and start the next segment where it should have been
+                if not in_intersection and odometry.is_overdue(expected, distance):
+                    print('missed intersection')
+                    odometry.missed += 1
+                    odometry.suspect(key)
+                    flags |= FLAG_MISSED
+                    num -= 1
+                    segment += 1
+                    segment_start += expected
+                    key = self.segment_key(transitions, segment)
+                    expected = odometry.expected(key)
+                    suspect = False
+
+                # move the forward speed towards the cruise speed (or back to the normal speed for the last intersection)
+                target = self.cruise_speed if ramp and num > 1 else speed
+                speed_step = self.ramp_rate * self.control_loop.period
+                v = min(v + speed_step, target) if v < target else max(v - speed_step, target)
+
+                # find the difference in brightness between the left and right sides of the line
+                line_dif = (g - b) / 1000
+
+                # determine the amount to steer based on the PID controller (tuned for ticks at the full rate)
+                steering = self.line_PID.calculate(line_dif, self.control_rate / self.control_loop.rate)
+
+                # generate the speeds for each motor based on the forward speed, and the steering amount
+                left = -min(max(-1, v + steering), 1)
+                right = -min(max(-1, v - steering), 1)
+                self.drive_left.set(round(left * 100))
+                self.drive_right.set(round(right * 100))
+
+            self.trace.record(self.clock.time(), g, b, line_dif, steering, self.drive_left.speed or 0, self.drive_right.speed or 0, flags)
+
+        # the robot rolls past the intersection at the full rate
+        self.control_loop.set_rate(self.control_rate)
+
+        # the loop will exit immediately when the robot exits the intersection
+        # the robot needs to "roll past" the intersection a small amount so the wheels are more in-line with the grid
+        # (the color sensor is a couple cm in front of the axle line)
+        # the distance is measured on the wheel encoder so the motors do not have to stop at the end of it
+        # (the motors are mounted backwards, so negative speeds drive the robot forward)
+        # the wheel has stalled (such as against a pallet) if it has not turned for 'stall_time' seconds
+        roll_past = 0.65
+        stall_time = 0.5
+        start_position = last_position = self.motor_left.position
+        last_moved = self.clock.time()
+        self.drive_left.set(round(-v * 100))
+        self.drive_right.set(round(-v * 100))
+        while abs(self.motor_left.position - start_position) < roll_past * 360:
+            self.check_cancelled()
+            self.poll_lift()
+            self.control_loop.wait()
+
+            position = self.motor_left.position
+            if position != last_position:
+                last_position = position
+                last_moved = self.clock.time()
+            elif self.clock.time() - last_moved > stall_time:
+                # stop where the wheel stalled and carry on, like a blocking on_for_rotations returns on a stall
+                print('drive motors stalled rolling past the intersection')
+                self.drive_left.off()
+                self.drive_right.off()
+                break
+
+        if not blend:
+            self.drive_left.off()
+            self.drive_right.off()
+
+    # the odometry key of segment 'i' of a forward move through 'transitions', or None if it is not known
+    def segment_key(self, transitions, i):
+        if transitions is None or i >= len(transitions):
+            return None
+        return self.odometry.segment(transitions[i], i == 0)
+
+    # this function executes a turns
+    # 'num' represents how many paths to turn past at an intersection
+    # 'right' represents direction to turn (True = turn right, False = turn left)
+    # 'speed' represents the speed to turn the robot at
+    # 'blend' leaves the motors running at the end so the next action can start without stopping
+    @timed('motion_seconds', primitive='turn')
+    def move_turn(self, num=1, right=True, speed=0.2, blend=False):
+        light_threshold, dark_threshold = self.turn_thresholds
+
+        # repeat the command in a loop so consecutive turns are run smoothly
+        self.control_loop.start()
+        while num > 0:
+            # the state variable for a single turn movement
+            state = 0
+            while True:
+                self.check_cancelled()
+                self.poll_lift()
+                self.control_loop.wait()
+
+                # get the green and blue channels of the color sensor for line-detection
+                g, b = self.color_reader.read()
+
+                # choose the outside channel to detect passing over the line
+                light_value = g if right else b
+
+                # beginning of the turn (robot was centered on the line and the outside color channel should get darker as it passes over the line)
+                if state == 0:
+                    # when the outside color channel goes high, the robot has turned past the first line, and now needs to detect when another line appears
+                    if light_value > light_threshold:
+                        state = 1
+
+                # the robot is between two lines and waiting until it turns onto the next line
+                elif state == 1:
+                    # the color channel which was previously light, has now gone dark, meaning the robot has completed one turn
+                    if light_value < dark_threshold:
+                        # decrease the number of remaining turns, and repeat the process again
+                        self.trace.record(self.clock.time(), g, b, 0, 0, self.drive_left.speed or 0, self.drive_right.speed or 0, FLAG_LINE)
+                        num -= 1
+                        break
+
+                # tell motors to move in opposite directions at the desired speed
+                speed_scalar = 1 if right else -1
+                self.drive_left.set(round(-speed_scalar * speed * 100))
+                self.drive_right.set(round(speed_scalar * speed * 100))
+                self.trace.record(self.clock.time(), g, b, 0, 0, self.drive_left.speed, self.drive_right.speed, 0)
+
+        # turn off the motors at the end of the set of turns so there is no annoying high-frequency humming
+        if not blend:
+            self.drive_left.off()
+            self.drive_right.off()
+
+    # move the robot straight back at a certain speed for a certain number of rotations
+    @timed('motion_seconds', primitive='back')
+    def move_back(self, speed=0.2, distance=1.6):
+        self.motor_left.on_for_rotations(round(speed * 100),
+                                         distance,
+                                         block=False)
+        self.motor_right.on_for_rotations(round(speed * 100), distance, block=False)
+
+        # wait for the robot to stop (as a blocking on_for_rotations would), checking on the lift in the meantime
+        while not self.motor_right.wait_until_not_moving(timeout=round(LiftMove.POLL_INTERVAL * 1000)):
+            self.poll_lift()
+        self.drive_left.reset()
+        self.drive_right.reset()
+
+    # calibrate the color sensor and the lift
+    # the stored calibration is used when a quick check shows it is still valid, otherwise the full routines are run (and stored)
+    def calibrate(self, calibration_path=None):
+        store = CalibrationStore(calibration_path) if calibration_path is not None else None
+        calibration = (store.load() if store is not None else None) or {}
+
+        white = calibration.get('white')
+        if white is not None:
+            self.sensor_color.red_max, self.sensor_color.green_max, self.sensor_color.blue_max = white
+        if white is None or not self.check_white():
+            print('Calibrating color sensor')
+            self.calibrate_white()
+            calibration['white'] = [self.sensor_color.red_max, self.sensor_color.green_max, self.sensor_color.blue_max]
+
+        # the lift position is only comparable within the same boot, because the motor position counters are reset on boot
+        lift_up_position = calibration.get('lift_up_position')
+        if calibration.get('boot_id') != boot_id() or lift_up_position is None or not self.restore_lift(lift_up_position):
+            print('Calibrating lift')
+            self.calibrate_lift()
+            calibration['lift_up_position'] = self.lift_up_position
+            calibration['boot_id'] = boot_id()
+
+        if store is not None:
+            store.save(calibration)
+
+    # white balance calibration procedure
+    def calibrate_white(self):
+        # rotate the robot ~45 degrees off the path so the color sensor has a white background for calibration
+        turn_distance = 0.75
+        self.motor_left.on_for_rotations(20, turn_distance, block=False)
+        self.motor_right.on_for_rotations(20, -turn_distance)
+
+        # calibrate the color sensor for following the line
+        self.sensor_color.calibrate_white()
+
+        # rotate the robot back to its original position before calibrating the color sensor
+        self.motor_left.on_for_rotations(20, -turn_distance, block=False)
+        self.motor_right.on_for_rotations(20, turn_distance)
+
+    # check that the current white balance makes sense for what the sensor sees while the robot sits on a line
+    def check_white(self):
+        maximum = (self.sensor_color.red_max, self.sensor_color.green_max, self.sensor_color.blue_max)
+        for _ in range(3):
+            raw = self.sensor_color.raw
+            for value, white in zip(raw, maximum):
+                # nothing on the floor should be much brighter than the calibrated white, and the sensor should see some light
+                if value > white * 1.1 or value < white * 0.05:
+                    return False
+
+            # the line under the sensor should be clearly darker than white on at least one of the line-following channels
+            if min(raw[1] / maximum[1], raw[2] / maximum[2]) > 0.85:
+                return False
+        return True
+
+    # restore the lift state from the stored position of the lift when it is up, checking it against the IR sensor
+    # returns False if the lift is not where it should be for either state
+    def restore_lift(self, up_position, tolerance=20):
+        position = self.motor_lift.position
+        lift_seen = self.sensor_infrared.proximity < 70
+
+        if abs(position - up_position) < tolerance and lift_seen:
+            self.lift_state = LiftState.up
+        elif abs(position - (up_position + 180)) < tolerance and not lift_seen:
+            self.lift_state = LiftState.down
+        else:
+            return False
+
+        self.lift_up_position = up_position
+        return True
+
+    # lift calibration procedure
+    def calibrate_lift(self):
+        # set the lift motor to move up at 10% speed
+        self.motor_lift.on(-10)
+
+        # wait until the IR sensor detects the forklift in front of it
+        while self.sensor_infrared.proximity >= 70:
+            pass
+
+        # set the robot's internal lift-state to 'up', and remember where the motor is when the lift is up
+        self.lift_state = LiftState.up
+        self.lift_up_position = self.motor_lift.position
+
+        # lower the lift
+        self.set_lift(LiftState.down)
+
+    # a controlled function to ensure proper lift control (don't allow raising it even more if the lift is already up...)
+    # with 'block' False the lift is left moving (see wait_lift), so the robot can drive in the meantime
+    # a movement in the other direction waits for the last one to finish first
+    def set_lift(self, state, block=True):
+        # the lift is already in (or still moving to) the desired position, so a movement in progress is left running
+        if state == self.lift_state:
+            if block:
+                self.wait_lift()
+            return
+
+        # the lift can only change direction once the movement in progress has finished
+        self.wait_lift()
+        self.lift_move = LiftMove(self, state)
+        if state == LiftState.up:
+            # if the lift needs to be raised, turn the motor just the right amount
+            self.motor_lift.on_for_rotations(10, -0.5, block=False)
+            # DO NOT turn off the motor because it is probably holding some weight on the forklift
+        elif state == LiftState.down:
+            # if the lift needs to be lowered, turn the motor just the right amount to be just above the ground
+            # (the motor is turned off once it gets there, see LiftMove.wait)
+            self.motor_lift.on_for_rotations(10, 0.5, block=False)
+
+        # set the robot's internal lift state for safe control
+        self.lift_state = state
+        if block:
+            self.wait_lift()
+
+    # note when the lift movement in progress (if any) finishes, so its time does not include the driving after it
+    def poll_lift(self):
+        if self.lift_move is not None:
+            self.lift_move.poll()
+
+    # wait for the lift movement in progress (if any) to finish
+    def wait_lift(self):
+        if self.lift_move is not None:
+            self.lift_move.wait()
+            self.lift_move = None
+
+    # turn off all motors and lights
+    def poweroff(self):
+        self.jobs.cancel()
+        self.motor_left.off(brake=False)
+        self.motor_right.off(brake=False)
+        self.motor_lift.off(brake=False)
+        self.leds.set_color('LEFT', 'BLACK')
+        self.leds.set_color('RIGHT', 'BLACK')
@@ -1,6 +1,13 @@
 from enum import IntEnum
 import time
-from math import inf
+import heapq
+import threading
+from array import array
+from math import inf, isnan
+
+from routes import RouteTable
+from replan import DStarLite
+from reachability import ReachabilityIndex
 
 
 # individual states the robot can be at (position and direction)
@@ -69,23 +76,41 @@ class ActionType(IntEnum):
     right = 2
 
 
+# the estimated time in seconds to perform each type of action, used until a transition has been timed
+DEFAULT_DURATIONS = {
+    ActionType.forward: 1.5,
+    ActionType.left: 1.0,
+    ActionType.right: 1.0,
+}
+
+
 # a basic object to hold an action type and the number of repeats
+# 'transitions' holds the transitions the action performs (one for each repeat) when it was generated from a route
 class Action:
+    __slots__ = ('action_type', 'n', 'transitions')
+
     def __init__(self, action_type, n=1):
         self.action_type = action_type
         self.n = n
+        self.transitions = []
 
 
 # used to represent the action performed when moving from an initial state 's0' to a final state 's'
 # invertible is an extra addition to make defining the trasition array easier
 # (for most positions on the layout, turning right after turning left would be the inverse or opposite action)
 class Transition:
+    __slots__ = ('s0', 's', 'action', 'invertible', 'duration', 'samples')
+
     def __init__(self, s0, s, action, invertible=True):
         self.s0 = s0
         self.s = s
         self.action = action
         self.invertible = invertible
 
+        # running estimate of the time taken to perform this transition (None until it has been measured)
+        self.duration = None
+        self.samples = 0
+
     # return the inverse transition if defined
     def inverse(self):
         # some transitions may specifically not be invertible depending on circumstances of the layout
@@ -103,20 +128,100 @@ class Transition:
 
     # the cost of this transition to use when finding the shortest path between states
     def cost(self):
-        # right now, each action costs the same amount, but if you had more complex layouts, the distance
-        # between intersections could be factored in to find the actual least cost/time/distance path between states
-        return 1
-
-
-# class to handle all navigation commands and generate routes between states
-class Navigator:
-    def __init__(self, s):
+        # the measured time to perform the transition, or an estimate based on the type of action if it has not been timed yet
+        if self.duration is None:
+            return DEFAULT_DURATIONS[self.action]
+        return self.duration
+
+    # update the running estimate of the time taken with a new measurement in seconds
+    # 'alpha' is the weight of the new measurement in the exponential moving average
+    def record(self, seconds, alpha=0.3):
+        if self.duration is None:
+            self.duration = seconds
+        else:
+            self.duration += alpha * (seconds - self.duration)
+        self.samples += 1
+
+
+# compact storage of a list of transitions, in compressed sparse row (CSR) form for fast searches
+# the edges leaving state s are first[s] to first[s + 1] - 1, and each edge is described by the parallel arrays:
+#   source, target  - the initial and final states
+#   action          - the ActionType
+#   cost            - the cost of the transition (kept in sync with Transition.cost() by the Navigator)
+#   transition      - the index of the Transition object in the list the graph was built from
+# a few flat arrays take far less memory than lists of objects, and searches over them allocate nothing per edge
+class TransitionGraph:
+    __slots__ = ('num_states', 'first', 'source', 'target', 'action', 'cost', 'transition', 'transitions')
+
+    def __init__(self, num_states, transitions):
+        self.num_states = num_states
+
+        # order the edges by initial state (keeping the order of the list within each state)
+        order = sorted(range(len(transitions)), key=lambda i: transitions[i].s0)
+
+        self.first = array('i', [0]) * (num_states + 1)
+        for t in transitions:
+            self.first[t.s0 + 1] += 1
+        for s in range(num_states):
+            self.first[s + 1] += self.first[s]
+
+        self.source = array('i', [transitions[i].s0 for i in order])
+        self.target = array('i', [transitions[i].s for i in order])
+        self.action = array('b', [transitions[i].action for i in order])
+        self.cost = array('d', [transitions[i].cost() for i in order])
+        self.transition = array('i', order)
+        self.transitions = transitions
+
+    def __len__(self):
+        return len(self.source)
+
+    # the edge index of a Transition object from the list the graph was built from (found among the few edges of its initial state)
+    def edge(self, t):
+        for e in range(self.first[t.s0], self.first[t.s0 + 1]):
+            if self.transitions[self.transition[e]] is t:
+                return e
+        raise KeyError(t)
+
+
+# a warehouse layout: the states the robot can be at, and the transitions between them
+# states are integer IDs, with a name for each one so they can be referred to by the Alexa skill
+class Layout:
+    def __init__(self, names, transitions, aliases={}, positions=None):
+        # names[s] is the name of state 's'
+        self.names = names
+
+        # the transitions defined for the layout (inverse transitions are generated by the Navigator)
+        self.transitions = transitions
+
+        # positions[s] is the (x, y) grid position of the intersection state 's' is at, or None if unknown
+        self.positions = positions
+
+        # index to look up the state for a name, including any human-readable aliases for states
+        self.index = {name: s for s, name in enumerate(names)}
+        for alias, name in aliases.items():
+            self.index[alias] = self.index[name]
+
+    # the number of states in the layout
+    def __len__(self):
+        return len(self.names)
+
+    # look up the state with a name (raises KeyError if there is no such state)
+    def state(self, name):
+        return self.index[name]
+
+    # look up the name of a state
+    def name(self, s):
+        return self.names[s]
+
+    # the layout for the map on the hackster.io project, with states defined by the 'State' enum
+    @classmethod
+    def default(cls):
         # transition array defined for the map on the hackster.io project
         # feel free to copy this same structure if you use a different layout
 
         # Transition(State.start, State.ave1_1_w, ActionType.forward) represents...
         # Execute 'forward' to get from 'start' to 'ave1_1_w'
-        self.transitions = [
+        transitions = [
             Transition(State.start, State.ave1_1_w, ActionType.forward),
             Transition(State.ave1_1_w, State.ave1_1_n, ActionType.right),
             Transition(State.ave1_1_w, State.ave1_1_s, ActionType.left),
@@ -169,6 +274,31 @@ class Navigator:
             Transition(State.ave1_7_s, State.ave1_6_s, ActionType.forward),
         ]
 
+        # grid position of each intersection (avenue 1 runs north from row 1, the intersection for row 0 is just west of row 1, and the start is just east of it)
+        positions = []
+        for s in State:
+            if s == State.start:
+                positions.append((1, 1))
+            else:
+                row = int(s.name.split('_')[1])
+                positions.append((0, row) if row > 0 else (-1, 1))
+
+        layout = cls([s.name for s in State], transitions, positions=positions)
+
+        # use the enum members (and all their aliases) as the states so they print with their names
+        layout.index = dict(State.__members__)
+        return layout
+
+
+# class to handle all navigation commands and generate routes between states
+class Navigator:
+    # 'layout' is the Layout to navigate (the map on the hackster.io project if not given)
+    def __init__(self, s, layout=None):
+        if layout is None:
+            layout = Layout.default()
+        self.layout = layout
+        self.transitions = list(layout.transitions)
+
         # generate the extra inverse transitions based on each transition already defined
         inv_transitions = []
         for t in self.transitions:
@@ -179,73 +309,394 @@ class Navigator:
         # add the auto-generated inverse transitions to the transitions array
         self.transitions += inv_transitions
 
+        # store the transitions in a compact graph that the searches run over
+        self._build_graph()
+
+        # which states can reach which, so routes that do not exist are rejected without searching
+        self.reachability = ReachabilityIndex(self.graph)
+
+        # the lowest cost per grid unit of any transition, used by the A* heuristic
+        # it is only ever lowered, so it stays a lower bound on the true costs as measurements come in
+        self.use_heuristic = layout.positions is not None and None not in layout.positions
+        self._unit_cost = inf
+        for t in self.transitions:
+            self._update_heuristic(t)
+
+        # the number of states expanded by the last search
+        self.expanded = 0
+
+        # optional precomputed all-pairs route table (see enable_route_table)
+        self.use_route_table = False
+        self.route_table = None
+        self._route_cache = None
+
+        # states and transitions that are temporarily blocked (see block_state and block_transition)
+        # while anything is blocked, routes are planned by incremental searches (one per goal state) that are repaired as blockages change
+        self.blocked_states = set()
+        self.blocked_transitions = set()
+        self._repairs = {}
+
+        # routes can be planned from more than one thread (such as a sequence planned while the robot runs a job),
+        # but the searches share scratch arrays, so only one runs at a time
+        # everything that changes the graph, its costs or what is blocked (such as recording the times of the job being run) holds
+        # the lock as well, so a search never sees a half-made change
+        self._route_lock = threading.RLock()
+
+        # counts every change to the transitions, their costs or what is blocked, so anything derived from them (such as cached
+        # route costs) can tell when it is out of date
+        self.version = 0
+
         # set the initial state
         self.state = s
 
+    # (re)build the compact graph of the transitions, and the scratch arrays the searches use
+    def _build_graph(self):
+        n = len(self.layout)
+        self.graph = TransitionGraph(n, self.transitions)
+
+        # per-state search scratch space, allocated once and reset after each search, so a search only allocates its heap
+        self._weights = array('d', [inf]) * n
+        self._via = array('i', [-1]) * n
+        self._visited = bytearray(n)
+
+        # the blocked flag of each edge
+        self._blocked = bytearray(len(self.graph))
+        if getattr(self, 'blocked_states', None) or getattr(self, 'blocked_transitions', None):
+            self._update_blocked(range(len(self.graph)))
+
+    # add a transition to the layout (and its inverse if it has one), keeping the graph in sync
+    def add_transition(self, t):
+        with self._route_lock:
+            ts = [t]
+            inv = t.inverse()
+            if inv is not None:
+                ts.append(inv)
+
+            for t in ts:
+                self.transitions.append(t)
+                self._update_heuristic(t)
+            self._build_graph()
+            for t in ts:
+                self.reachability.add(self.graph, t.s0, t.s)
+            self._layout_changed()
+
+    # remove a transition from the layout, keeping the graph in sync
+    # (the inverse is not removed automatically because it may still be wanted, such as when closing one direction of a path)
+    def remove_transition(self, t):
+        with self._route_lock:
+            self.transitions.remove(t)
+            self.blocked_transitions.discard(t)
+            self._build_graph()
+            self.reachability.remove(self.graph, t.s0, t.s)
+            self._layout_changed()
+
+    # called whenever the transitions change so any derived data is kept valid
+    def _layout_changed(self):
+        with self._route_lock:
+            self.version += 1
+
+            # the route table is rebuilt (or reloaded from the cache) on the next query
+            self.route_table = None
+
+            # the incremental searches start over on the next query
+            self._repairs = {}
+
+    # stop routes from entering state 's' until it is unblocked (a robot already at 's' can still leave it)
+    def block_state(self, s):
+        with self._route_lock:
+            if s not in self.blocked_states:
+                self.blocked_states.add(s)
+                self._update_blocked([e for e in range(len(self.graph)) if self.graph.target[e] == s])
+
+    def unblock_state(self, s):
+        with self._route_lock:
+            if s in self.blocked_states:
+                self.blocked_states.remove(s)
+                self._update_blocked([e for e in range(len(self.graph)) if self.graph.target[e] == s])
+
+    # stop routes from using transition 't' until it is unblocked
+    def block_transition(self, t):
+        with self._route_lock:
+            if t not in self.blocked_transitions:
+                self.blocked_transitions.add(t)
+                self._update_blocked([self.graph.edge(t)])
+
+    def unblock_transition(self, t):
+        with self._route_lock:
+            if t in self.blocked_transitions:
+                self.blocked_transitions.remove(t)
+                self._update_blocked([self.graph.edge(t)])
+
+    # unblock everything
+    def clear_blockages(self):
+        with self._route_lock:
+            self.blocked_states.clear()
+            self.blocked_transitions.clear()
+            self._blocked = bytearray(len(self.graph))
+            self._repairs = {}
+            self.version += 1
+
+    # update the blocked flags of some edges of the graph, and let the incremental searches know they changed
+    def _update_blocked(self, edges):
+        graph = self.graph
+        for e in edges:
+            t = self.transitions[graph.transition[e]]
+            self._blocked[e] = t in self.blocked_transitions or t.s in self.blocked_states
+        self._edges_changed(edges)
+
+    # let the incremental searches know which edges were blocked, unblocked or changed cost, so they only repair those parts of their routes
+    def _edges_changed(self, edges):
+        self.version += 1
+        for repair in self._repairs.values():
+            repair.update(edges)
+
+    # whether transition 't' can be used right now
+    def is_open(self, t):
+        return t not in self.blocked_transitions and t.s not in self.blocked_states
+
+    # the cost of edge 'e' of the graph, or infinity while it is blocked
+    def edge_cost(self, e):
+        if self._blocked[e]:
+            return inf
+        return self.graph.cost[e]
+
+    # lower the cost per grid unit used by the A* heuristic if a transition covers distance more cheaply
+    def _update_heuristic(self, t):
+        if not self.use_heuristic:
+            return
+        distance = self._distance(t.s0, t.s)
+        if distance > 0:
+            self._unit_cost = min(self._unit_cost, t.cost() / distance)
+
+    # the grid (manhattan) distance between the intersections of two states
+    def _distance(self, s0, s):
+        x0, y0 = self.layout.positions[s0]
+        x, y = self.layout.positions[s]
+        return abs(x - x0) + abs(y - y0)
+
+    # record the measured time of an action performed along a route (generated by path_to)
+    # the time is split evenly across the repeats of the action
+    def record(self, action, seconds):
+        with self._route_lock:
+            if not action.transitions:
+                return
+
+            seconds /= len(action.transitions)
+            replan = False
+            edges = []
+            for t in action.transitions:
+                old = t.cost()
+                t.record(seconds)
+                self._update_heuristic(t)
+
+                e = self.graph.edge(t)
+                self.graph.cost[e] = t.cost()
+                edges.append(e)
+
+                # only rebuild the route table for significant changes so it is not rebuilt after every move
+                if abs(t.cost() - old) > 0.1 * old:
+                    replan = True
+
+            if replan:
+                self._layout_changed()
+            else:
+                self._edges_changed(edges)
+
+    # take the stored measurements of transitions that have not been measured yet (such as the durations saved with the route table
+    # before a restart), given as parallel arrays of durations (NaN if not measured) and sample counts in the order of 'transitions'
+    def restore_durations(self, durations, samples):
+        with self._route_lock:
+            if len(durations) != len(self.transitions):
+                return
+            edges = []
+            for t, duration, n in zip(self.transitions, durations, samples):
+                if t.duration is None and not isnan(duration):
+                    t.duration = duration
+                    t.samples = n
+                    self._update_heuristic(t)
+
+                    e = self.graph.edge(t)
+                    self.graph.cost[e] = t.cost()
+                    edges.append(e)
+            if edges:
+                self._edges_changed(edges)
+
+    # precompute the next-hop and distance tables for every pair of states so routes can be looked up instead of searched for
+    # if 'cache_path' is given, the tables are loaded from that file when it matches the current transitions, and saved to it otherwise
+    def enable_route_table(self, cache_path=None):
+        with self._route_lock:
+            self.use_route_table = True
+            self._route_cache = cache_path
+            self.route_table = RouteTable.load_or_build(self, cache_path)
+
+    # stop using the precomputed route table, and fall back to searching for every route
+    def disable_route_table(self):
+        with self._route_lock:
+            self.use_route_table = False
+            self._route_cache = None
+            self.route_table = None
+
     # returns the list of possible transitions from a state 's0' excluding those in the 'exclude' list
-    def possible_transitions(self, s0, exclude=[]):
-        ts = []
-        for t in self.transitions:
-            if t.s0 == s0 and t.s not in exclude:
-                ts.append(t)
-        return ts
-
-    # generate the path to a desired state from the current state
-    # based on Dijkstra's path finding algorithm
-    def path_to(self, end_state):
-        prev_action = None
-
-        # initialize the weights of all nodes to infinity because they have not been visited (except for 0 for the current state because it costs nothing to remain where you are)
-        n_states = len(set(State))
-        visited = set()
-        weights = {}
-        for s in State:
-            weights[s] = (inf, None) if s != self.state else (0, None)
-
-        # iterate through the remaining unvisited states
-        while len(visited) < n_states:
-            # find the current lowest cost state
-            s0 = None
-            s0_w = inf
-            for s in weights:
-                if s not in visited:
-                    if weights[s][0] < s0_w:
-                        s0 = s
-                        s0_w = weights[s][0]
+    # blocked transitions are left out unless 'include_blocked' is True
+    def possible_transitions(self, s0, exclude=[], include_blocked=False):
+        graph = self.graph
+        return [self.transitions[graph.transition[e]] for e in range(graph.first[s0], graph.first[s0 + 1])
+                if graph.target[e] not in exclude and (include_blocked or not self._blocked[e])]
+
+    # generate the list of transitions leading from the current state (or 'start_state' if given) to a desired state
+    # returns None if the desired state cannot be reached
+    def route_to(self, end_state, start_state=None):
+        if start_state is None:
+            start_state = self.state
+
+        with self._route_lock:
+            # states that are not connected at all have no route, whatever is blocked
+            if not self.reachability.reachable(start_state, end_state):
+                self.expanded = 0
+                return None
+
+            # while anything is blocked, repair the incremental search for this goal instead of searching again
+            # (the route table only holds routes for the unblocked layout)
+            if self.blocked_states or self.blocked_transitions:
+                repair = self._repairs.get(end_state)
+                if repair is None:
+                    repair = self._repairs[end_state] = DStarLite(self, end_state)
+                route = repair.route(start_state)
+                self.expanded = repair.expanded
+                return route
+
+            # use the precomputed route table if it is enabled (rebuilding it if the layout changed since it was built)
+            if self.use_route_table:
+                if self.route_table is None:
+                    self.route_table = RouteTable.load_or_build(self, self._route_cache)
+                return self.route_table.route(start_state, end_state)
+
+            return self._search(start_state, end_state)
+
+    # find the lowest cost of reaching every reachable state from state 's0' (avoiding blocked states and transitions)
+    # returns a dictionary of state -> cost (unreachable states are left out)
+    def costs_from(self, s0):
+        with self._route_lock:
+            graph = self.graph
+            first, target, cost, blocked = graph.first, graph.target, graph.cost, self._blocked
+
+            costs = {}
+            heap = [(0, s0)]
+            while heap:
+                w0, s = heapq.heappop(heap)
+                if s in costs:
+                    continue
+                costs[s] = w0
+
+                for e in range(first[s], first[s + 1]):
+                    if not blocked[e] and target[e] not in costs:
+                        heapq.heappush(heap, (w0 + cost[e], target[e]))
+            return costs
+
+    # find the lowest cost route between two states
+    # based on the A* path finding algorithm, using a binary heap as the priority queue
+    # the heuristic is the grid distance to the end state times the lowest cost per grid unit, which never overestimates the remaining cost
+    # (without grid positions for the layout, the heuristic is 0 and this is Dijkstra's algorithm)
+    # the search runs over the compact graph, and keeps its per-state data in the navigator's scratch arrays (so it is not thread-safe)
+    def _search(self, start_state, end_state):
+        if self.use_heuristic and self._unit_cost < inf:
+            unit_cost = self._unit_cost
+            end_x, end_y = self.layout.positions[end_state]
+            positions = self.layout.positions
+
+            def heuristic(s):
+                x, y = positions[s]
+                return unit_cost * (abs(end_x - x) + abs(end_y - y))
+        else:
+            def heuristic(s):
+                return 0
+
+        graph = self.graph
+        first, source, target, cost, blocked = graph.first, graph.source, graph.target, graph.cost, self._blocked
+
+        # the cost to reach each state found so far, the edge used to reach it, and whether it was visited
+        # (every state reached is remembered in 'touched' so the scratch arrays can be reset afterwards)
+        weights, via, visited = self._weights, self._via, self._visited
+        weights[start_state] = 0
+        touched = [start_state]
+        expanded = 0
+        found = False
+
+        # the heap holds (estimated total cost, -cost so far, state), so ties go to the state furthest along its route
+        heap = [(heuristic(start_state), 0, start_state)]
+
+        while heap:
+            # pop the state with the lowest estimated total cost
+            _, s0_w, s0 = heapq.heappop(heap)
+            s0_w = -s0_w
+
+            # skip stale heap entries for states that were already reached at a lower cost
+            if visited[s0]:
+                continue
 
             # 'visit' the lowest cost state
-            visited.add(s0)
+            visited[s0] = 1
+            expanded += 1
+
+            # the shortest path to the destination is known as soon as it is visited
+            if s0 == end_state:
+                found = True
+                break
 
             # find all transitions from the lowest cost state
-            for t in self.transitions:
-                if t.s not in visited and t.s0 == s0:
-                    w = s0_w + t.cost()
+            for e in range(first[s0], first[s0 + 1]):
+                s = target[e]
+                if not visited[s] and not blocked[e]:
+                    w = s0_w + cost[e]
                     # only allow for reducing the cost of neighboring states
-                    if w < weights[t.s][0]:
-                        # update the cost of the neighboring state, and store which node the transition is from
-                        weights[t.s] = (w, t)
+                    if w < weights[s]:
+                        if weights[s] == inf:
+                            touched.append(s)
+                        # update the cost of the neighboring state, and store which edge it was reached by
+                        weights[s] = w
+                        via[s] = e
+                        heapq.heappush(heap, (w + heuristic(s), -w, s))
+
+        self.expanded = expanded
+
+        # retrace the path backward from the destination, counting its length first so the route is allocated once and filled from the end
+        route = None
+        if found:
+            n = 0
+            s = end_state
+            while s != start_state:
+                n += 1
+                s = source[via[s]]
+
+            route = [None] * n
+            s = end_state
+            while n > 0:
+                n -= 1
+                e = via[s]
+                route[n] = self.transitions[graph.transition[e]]
+                s = source[e]
+
+        for s in touched:
+            weights[s] = inf
+            via[s] = -1
+            visited[s] = 0
+        return route
+
+    # generate the path to a desired state from the current state (or 'start_state' if given)
+    def path_to(self, end_state, start_state=None):
+        route = self.route_to(end_state, start_state)
+        if route is None:
+            return None
 
-        # iterate through the path in reverse order to find the sequence of moves
-        s = end_state
+        # group the transitions into actions
         actions = []
-        while s != self.state:
-            # retrace the steps of Djikstra's path finding algorithm
-            t = weights[s][1]
-            if t is None:
-                return None
-
-            # get the action performed by the transition
-            a = Action(t.action)
-
-            # if there is already an action with the same type in the list, increase the number of repetitions rather than adding another action
-            if len(actions) > 0 and actions[0].action_type == a.action_type:
-                actions[0].n += 1
+        for t in route:
+            # if the last action has the same type, increase the number of repetitions rather than adding another action
+            if len(actions) > 0 and actions[-1].action_type == t.action:
+                actions[-1].n += 1
             else:
-                # insert a new action
-                actions.insert(0, a)
-
-            # move backward along the path
-            s = t.s0
+                actions.append(Action(t.action))
+            actions[-1].transitions.append(t)
 
         # return the final sequence of actions to get from state 's0' to state 's'
         return actions
@@ -0,0 +1,90 @@
+# measures how far the robot has driven on the drive motors' position counters, and learns how far apart the intersections are
+#
+# distances are in degrees of wheel rotation, so nothing depends on the wheel size or the size of the grid
+# the distance of each kind of segment is learned from where the color sensor finds the intersections, and is only trusted once
+# 'min_samples' drives in a row agree on it (within the tolerance), so an intersection missed while learning is not learned as a
+# segment twice as long
+# from then on a segment is:
+#  - in the middle while less than (1 - tolerance) of its expected distance has been driven, where an intersection is too early
+#    to be real (a phantom, such as a mark or shadow on the floor)
+#  - overdue once more than (1 + tolerance) of its expected distance has been driven, where the intersection must have been missed
+# a trusted distance that keeps finding phantoms or missing intersections is probably wrong, so it is forgotten and learned again
+class Odometry:
+    # 'positions' are the grid positions of the layout's states (None if it has none)
+    def __init__(self, motor_left, motor_right, positions=None, tolerance=0.25, min_samples=3):
+        self.motor_left = motor_left
+        self.motor_right = motor_right
+        self.positions = positions if positions is not None and None not in positions else None
+        self.tolerance = tolerance
+        self.min_samples = min_samples
+
+        # segment key -> (learned distance, number of drives in a row that agreed on it)
+        self.spacing = {}
+
+        # segment key -> number of drives in a row that found a phantom or missed the intersection
+        self.suspects = {}
+
+        # the number of intersections missed and phantom intersections ignored so far
+        self.missed = 0
+        self.phantoms = 0
+
+    # the distance driven forward since the position counters were reset (the average of both wheels, so turning does not count)
+    def position(self):
+        # the motors are mounted backwards, so driving forward counts down
+        return -(self.motor_left.position + self.motor_right.position) / 2
+
+    # the key of the segment ending at the intersection transition 't' leads to
+    # segments along the same grid axis over the same number of grid units are the same distance apart (and every transition is
+    # its own kind of segment without grid positions)
+    # the first segment of a forward move starts wherever the robot stopped (past an intersection, or after a turn), so it is
+    # learned separately from the segments between two intersections
+    def segment(self, t, first):
+        if self.positions is None:
+            return (t.s0, t.s, first)
+        (x0, y0), (x, y) = self.positions[t.s0], self.positions[t.s]
+        return (x != x0, abs(x - x0) + abs(y - y0), first)
+
+    # the expected distance of a segment, or None if it is not trusted yet
+    def expected(self, key):
+        learned = self.spacing.get(key)
+        if learned is None or learned[1] < self.min_samples:
+            return None
+        return learned[0]
+
+    # whether a distance driven agrees with the expected distance of a segment
+    def agrees(self, expected, distance):
+        return abs(distance - expected) <= expected * self.tolerance
+
+    # update the learned distance of a segment with one the color sensor just measured (with no phantom or missed intersection)
+    # while learning, a distance that does not agree with the ones before starts the learning over from it
+    # once the distance is trusted, distances that do not agree are dropped
+    def record(self, key, distance, alpha=0.3):
+        self.suspects.pop(key, None)
+        learned = self.spacing.get(key)
+        if learned is not None and self.agrees(learned[0], distance):
+            self.spacing[key] = (learned[0] + alpha * (distance - learned[0]), learned[1] + 1)
+        elif learned is None or learned[1] < self.min_samples:
+            self.spacing[key] = (distance, 1)
+
+    # count a drive of a segment that found a phantom or missed the intersection, and forget its distance once 'min_samples'
+    # drives in a row have (a mark on the floor only shows up on one of the segments of a kind, not on every drive of it)
+    def suspect(self, key):
+        count = self.suspects.get(key, 0) + 1
+        if count < self.min_samples:
+            self.suspects[key] = count
+        else:
+            self.forget(key)
+
+    # forget the distance of a segment, so it is learned again from the color sensor alone
+    def forget(self, key):
+        print('forgot the segment distance')
+        self.suspects.pop(key, None)
+        self.spacing.pop(key, None)
+
+    # whether an intersection found after driving 'distance' of a segment expected to be 'expected' long is too early to be real
+    def is_early(self, expected, distance):
+        return expected is not None and distance < expected * (1 - self.tolerance)
+
+    # whether the intersection of a segment expected to be 'expected' long should have been found by 'distance'
+    def is_overdue(self, expected, distance):
+        return expected is not None and distance > expected * (1 + self.tolerance)
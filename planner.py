@@ -0,0 +1,195 @@
+import time
+from itertools import permutations
+from math import inf
+
+
+# a pallet move: pick up the pallet at state 'src' and drop it at state 'dst'
+class Move:
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+
+    def __repr__(self):
+        return 'Move({}, {})'.format(self.src, self.dst)
+
+
+# plans the order to run a batch of pallet moves in so the total route cost is as low as possible
+#
+# after a pickup or drop the robot backs up to the state it came from, so each move costs the route from the previous
+# position to 'src' plus the route from 'src' to 'dst', and only the first part depends on the order
+# small batches are solved exactly, larger ones start from a nearest-neighbor order and are improved with or-opt and 2-opt
+class JobPlanner:
+    # batches up to this size are solved exactly
+    EXACT_LIMIT = 9
+
+    def __init__(self, nav):
+        self.nav = nav
+
+        # costs of all routes from each state searched so far, reused across queries until the layout changes
+        self._costs = {}
+        self._version = None
+
+    # the cost of the lowest cost route between two states
+    def cost(self, s0, s):
+        # drop the cached costs if the layout, the transition costs or the blockages changed since they were found
+        if self._version != self.nav.version:
+            self._costs = {}
+            self._version = self.nav.version
+
+        costs = self._costs.get(s0)
+        if costs is None:
+            costs = self._costs[s0] = self.nav.costs_from(s0)
+        return costs.get(s, inf)
+
+    # forget the cached route costs (call after the layout or the transition costs change)
+    def clear(self):
+        self._costs = {}
+
+    # find the order to run 'moves' in, starting from state 'start' (the navigator's current state if not given)
+    # 'time_limit' is the maximum time in seconds to spend improving the order of large batches
+    # returns the ordered list of moves and its total route cost
+    def plan(self, moves, start=None, time_limit=1.0):
+        if start is None:
+            start = self.nav.state
+        moves = list(moves)
+        if not moves:
+            return [], 0
+
+        for m in moves:
+            if self.cost(m.src, m.dst) == inf:
+                raise ValueError('No route from {} to {}'.format(m.src, m.dst))
+
+        # the fixed cost of carrying each pallet
+        carry = sum(self.cost(m.src, m.dst) for m in moves)
+
+        # empty travel costs: 'first[i]' from the start to move i, and 'between[i][j]' from the end of move i to the start of move j
+        # unreachable legs get a large finite cost so orders can still be compared
+        n = len(moves)
+        first = [self._leg(start, m.src) for m in moves]
+        between = [[self._leg(a.dst, b.src) for b in moves] for a in moves]
+
+        if n <= self.EXACT_LIMIT:
+            order = self._solve_exact(first, between)
+        else:
+            order = self._solve_heuristic(first, between, time_limit)
+
+        travel = self._order_cost(order, first, between)
+        return [moves[i] for i in order], carry + travel
+
+    # the cost of an empty leg between two moves, with a large penalty instead of infinity when there is no route
+    def _leg(self, s0, s):
+        c = self.cost(s0, s)
+        return c if c < inf else 1e9
+
+    # total empty travel cost of an order of moves
+    @staticmethod
+    def _order_cost(order, first, between):
+        c = first[order[0]]
+        for i in range(1, len(order)):
+            c += between[order[i - 1]][order[i]]
+        return c
+
+    # find the optimal order with the Held-Karp dynamic program
+    def _solve_exact(self, first, between):
+        n = len(first)
+        if n <= 3:
+            return list(min(permutations(range(n)), key=lambda o: self._order_cost(o, first, between)))
+
+        # best[mask][i] is the lowest cost of running the moves in 'mask', ending with move i
+        best = [[inf] * n for _ in range(1 << n)]
+        parent = [[-1] * n for _ in range(1 << n)]
+        for i in range(n):
+            best[1 << i][i] = first[i]
+
+        for mask in range(1, 1 << n):
+            row = best[mask]
+            for i in range(n):
+                c = row[i]
+                if c == inf:
+                    continue
+                b = between[i]
+                for j in range(n):
+                    if mask & (1 << j):
+                        continue
+                    m = mask | (1 << j)
+                    if c + b[j] < best[m][j]:
+                        best[m][j] = c + b[j]
+                        parent[m][j] = i
+
+        # trace the best order back from the full set
+        mask = (1 << n) - 1
+        i = min(range(n), key=lambda k: best[mask][k])
+        order = []
+        while i >= 0:
+            order.append(i)
+            i, mask = parent[mask][i], mask & ~(1 << i)
+        order.reverse()
+        return order
+
+    # build an order with the nearest-neighbor heuristic, then improve it with local search until no move helps or time runs out
+    def _solve_heuristic(self, first, between, time_limit):
+        n = len(first)
+        deadline = time.time() + time_limit
+
+        remaining = set(range(n))
+        i = min(remaining, key=lambda k: first[k])
+        order = [i]
+        remaining.remove(i)
+        while remaining:
+            b = between[order[-1]]
+            i = min(remaining, key=lambda k: b[k])
+            order.append(i)
+            remaining.remove(i)
+
+        improved = True
+        while improved and time.time() < deadline:
+            improved = self._or_opt(order, first, between) or self._two_opt(order, first, between)
+        return order
+
+    # the cost of the leg into position 'i' of an order (from the start for position 0)
+    @staticmethod
+    def _into(order, i, first, between):
+        if i == 0:
+            return first[order[0]]
+        return between[order[i - 1]][order[i]]
+
+    # try moving each segment of 1-3 consecutive moves to a better position, returns True if the order was improved
+    def _or_opt(self, order, first, between):
+        n = len(order)
+        cost = self._order_cost(order, first, between)
+        for length in (1, 2, 3):
+            for i in range(n - length + 1):
+                segment = order[i:i + length]
+                rest = order[:i] + order[i + length:]
+                for j in range(len(rest) + 1):
+                    if j == i:
+                        continue
+                    candidate = rest[:j] + segment + rest[j:]
+                    c = self._order_cost(candidate, first, between)
+                    if c < cost - 1e-9:
+                        order[:] = candidate
+                        return True
+        return False
+
+    # try reversing each segment of the order, returns True if the order was improved
+    # costs are not symmetric, so the legs inside the segment are recomputed as well as the two at its ends
+    def _two_opt(self, order, first, between):
+        n = len(order)
+        for i in range(n - 1):
+            for j in range(i + 1, n):
+                old = self._into(order, i, first, between)
+                for k in range(i + 1, j + 1):
+                    old += between[order[k - 1]][order[k]]
+                if j + 1 < n:
+                    old += between[order[j]][order[j + 1]]
+
+                new = first[order[j]] if i == 0 else between[order[i - 1]][order[j]]
+                for k in range(j, i, -1):
+                    new += between[order[k]][order[k - 1]]
+                if j + 1 < n:
+                    new += between[order[i]][order[j + 1]]
+
+                if new < old - 1e-9:
+                    order[i:j + 1] = order[i:j + 1][::-1]
+                    return True
+        return False
@@ -0,0 +1,251 @@
+import argparse
+from array import array
+
+
+# which states can reach which, from the strongly connected components of a navigator's graph
+#
+# every state of a component can reach every other state of it, so reachability only has to be stored between components:
+# each component has a bitset (a Python int) of the components it can reach, computed over the condensation of the graph
+# (the graph of the components, which has no cycles)
+# a query is a bit test, so a route between states that are not connected can be rejected without searching
+#
+# the index only covers the layout's transitions: blocked states and transitions are not part of it, so a route it allows can
+# still turn out to be blocked
+class ReachabilityIndex:
+    def __init__(self, graph):
+        self.num_states = graph.num_states
+
+        # the component of each state, and the components reachable from each component (indexed by component ID)
+        # IDs are not reused when components are merged, so '_live' keeps the IDs still in use
+        self.comp = array('i', [-1]) * graph.num_states
+        self.reach = []
+        self._live = set()
+
+        self._components(graph, range(graph.num_states))
+        self._compute_reach(graph)
+
+    # whether state 's' can be reached from state 's0'
+    def reachable(self, s0, s):
+        c0 = self.comp[s0]
+        c = self.comp[s]
+        return c0 == c or (self.reach[c0] >> c) & 1 == 1
+
+    # the number of strongly connected components
+    def __len__(self):
+        return len(self._live)
+
+    # find the components among 'states' (whose 'comp' entries are -1) with Tarjan's algorithm, without recursion
+    # the first component found keeps the ID 'reuse' if it is given, the others get new IDs
+    def _components(self, graph, states, reuse=None):
+        first, target, comp = graph.first, graph.target, self.comp
+        index = array('i', [-1]) * self.num_states
+        low = array('i', [0]) * self.num_states
+        on_stack = bytearray(self.num_states)
+        stack = []
+        counter = 0
+
+        for root in states:
+            if index[root] != -1:
+                continue
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = 1
+            work = [(root, first[root])]
+            while work:
+                s, e = work[-1]
+                end = first[s + 1]
+
+                # scan the edges of 's' until one leads to a new state (states outside 'states', and the states of components
+                # already found, have a component and are skipped)
+                while e < end:
+                    t = target[e]
+                    e += 1
+                    if comp[t] != -1:
+                        continue
+                    if index[t] == -1:
+                        break
+                    if on_stack[t] and index[t] < low[s]:
+                        low[s] = index[t]
+                else:
+                    t = -1
+
+                if t != -1:
+                    work[-1] = (s, e)
+                    index[t] = low[t] = counter
+                    counter += 1
+                    stack.append(t)
+                    on_stack[t] = 1
+                    work.append((t, first[t]))
+                    continue
+
+                work.pop()
+                if work:
+                    p = work[-1][0]
+                    if low[s] < low[p]:
+                        low[p] = low[s]
+
+                # 's' is the root of a component: everything above it on the stack belongs to it
+                if low[s] == index[s]:
+                    if reuse is not None:
+                        c = reuse
+                        reuse = None
+                    else:
+                        c = len(self.reach)
+                        self.reach.append(0)
+                    self._live.add(c)
+                    while True:
+                        t = stack.pop()
+                        on_stack[t] = 0
+                        comp[t] = c
+                        if t == s:
+                            break
+
+    # the edges of the condensation: the set of components directly reachable from each component
+    def _successors(self, graph):
+        comp, source, target = self.comp, graph.source, graph.target
+        successors = dict((c, set()) for c in self._live)
+        for e in range(len(graph)):
+            a = comp[source[e]]
+            b = comp[target[e]]
+            if a != b:
+                successors[a].add(b)
+        return successors
+
+    # compute the reachable components of every component, visiting the successors of each component before it
+    def _compute_reach(self, graph):
+        successors = self._successors(graph)
+        reach = self.reach
+        done = set()
+        for c0 in self._live:
+            if c0 in done:
+                continue
+            work = [(c0, iter(successors[c0]))]
+            while work:
+                c, pending = work[-1]
+                for d in pending:
+                    if d not in done:
+                        work.append((d, iter(successors[d])))
+                        break
+                else:
+                    work.pop()
+                    r = 1 << c
+                    for d in successors[c]:
+                        r |= reach[d]
+                    reach[c] = r
+                    done.add(c)
+
+    # update the index for a transition from 's0' to 's' added to the graph (which already includes it)
+    # this only touches the bitsets: every component that reaches 's0' now reaches everything 's' reaches, and if 's' already
+    # reached 's0', the components on the new cycle merge into one
+    def add(self, graph, s0, s):
+        cu, cv = self.comp[s0], self.comp[s]
+        reach = self.reach
+        if self.reachable(s0, s):
+            return
+
+        bit_u = 1 << cu
+        rv = reach[cv]
+        for c in self._live:
+            if reach[c] & bit_u:
+                reach[c] |= rv
+        if not rv & bit_u:
+            return
+
+        # the components between 's' and 's0' merge into the component with the lowest ID
+        members = [c for c in self._live if reach[c] & bit_u and (rv >> c) & 1]
+        mask = 0
+        for c in members:
+            mask |= 1 << c
+        merged = min(members)
+        for c in self._live:
+            if reach[c] & mask:
+                reach[c] |= mask
+        for c in members:
+            reach[merged] |= reach[c]
+            if c != merged:
+                reach[c] = 0
+                self._live.discard(c)
+
+        members = set(members)
+        comp = self.comp
+        for t in range(self.num_states):
+            if comp[t] in members:
+                comp[t] = merged
+
+    # update the index for a transition from 's0' to 's' removed from the graph (which no longer includes it)
+    # a component the transition was inside of may split, so only its own states are searched again; the bitsets are then
+    # recomputed over the condensation
+    def remove(self, graph, s0, s):
+        # nothing changes while another transition still leads from 's0' to 's'
+        for e in range(graph.first[s0], graph.first[s0 + 1]):
+            if graph.target[e] == s:
+                return
+
+        c = self.comp[s0]
+        if c == self.comp[s]:
+            states = [t for t in range(self.num_states) if self.comp[t] == c]
+            for t in states:
+                self.comp[t] = -1
+            self._components(graph, states, reuse=c)
+        self._compute_reach(graph)
+
+    # the largest component, the main part of the layout that the robot can move around freely in
+    def main_component(self):
+        sizes = {}
+        for c in self.comp:
+            sizes[c] = sizes.get(c, 0) + 1
+        return max(sizes, key=lambda c: (sizes[c], -c))
+
+    # the dead-end states: states the robot cannot get back to the main part of the layout from
+    def dead_ends(self):
+        main = self.main_component()
+        return [s for s in range(self.num_states) if not (self.reach[self.comp[s]] >> main) & 1]
+
+    # the states the robot cannot get to from the main part of the layout (such as a starting point it can only leave)
+    def unreachable(self):
+        reach = self.reach[self.main_component()]
+        return [s for s in range(self.num_states) if not (reach >> self.comp[s]) & 1]
+
+    # the states of each component, largest component first
+    def components(self):
+        members = {}
+        for s in range(self.num_states):
+            members.setdefault(self.comp[s], []).append(s)
+        return sorted(members.values(), key=lambda states: (-len(states), states[0]))
+
+
+# print the strongly connected components and the dead-end states of a layout
+def main():
+    from navigation import Navigator, State
+
+    parser = argparse.ArgumentParser(description='Report the parts of a layout the robot cannot get back from')
+    parser.add_argument('--layout', help='layout file to check (the hackster.io map if not given)')
+    args = parser.parse_args()
+
+    if args.layout:
+        from layout import load_layout
+        layout = load_layout(args.layout)
+        nav = Navigator(layout.state('start'), layout)
+    else:
+        nav = Navigator(State.start)
+    index = nav.reachability
+    name = nav.layout.name
+
+    components = index.components()
+    print('{} states in {} strongly connected components'.format(len(nav.layout), len(components)))
+    for states in components[1:]:
+        print('  {} states: {}'.format(len(states), ', '.join(name(s) for s in states)))
+
+    dead_ends = index.dead_ends()
+    print('{} dead-end states (no way back to the main part of the layout)'.format(len(dead_ends)))
+    for s in dead_ends:
+        can_reach = sum(1 for t in range(index.num_states) if index.reachable(s, t))
+        print('  {} (reaches {} of {} states)'.format(name(s), can_reach, index.num_states))
+
+    unreachable = index.unreachable()
+    print('{} states the main part of the layout cannot get to: {}'.format(len(unreachable), ', '.join(name(s) for s in unreachable)))
+
+
+if __name__ == '__main__':
+    main()
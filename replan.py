@@ -0,0 +1,165 @@
+import heapq
+from array import array
+from math import inf
+
+
+# incrementally maintained lowest cost routes from every state to one goal state, based on D* Lite (Koenig & Likhachev, 2002)
+#
+# the search runs backward from the goal, and stops as soon as the cost from the robot's current state is known
+# when edges are blocked, unblocked or change cost, update() only marks the states directly affected, and the next route()
+# repairs the costs of the states that actually changed instead of searching again from scratch
+# the robot moving along its route needs no new search either: the heuristic is relative to the current state, and the keys
+# already in the queue are corrected by the distance moved ('km')
+class DStarLite:
+    def __init__(self, nav, goal):
+        self.nav = nav
+        self.goal = goal
+
+        # the edges of the navigator's graph into each state (edges in_first[s] to in_first[s + 1] - 1 of 'in_edges'),
+        # to update the predecessors of a state whose cost changed
+        graph = nav.graph
+        self._in_edges = array('i', sorted(range(len(graph)), key=lambda e: graph.target[e]))
+        self._in_first = array('i', [0]) * (graph.num_states + 1)
+        for e in range(len(graph)):
+            self._in_first[graph.target[e] + 1] += 1
+        for s in range(graph.num_states):
+            self._in_first[s + 1] += self._in_first[s]
+
+        # the heuristic lower bound on the cost per grid unit, fixed for the lifetime of the search so the queued keys stay consistent
+        self._unit_cost = nav._unit_cost if nav.use_heuristic and nav._unit_cost < inf else 0
+
+        # g is the cost to the goal found by the last expansion of a state, rhs the cost based on its successors' g values
+        # states missing from either dictionary have an infinite cost
+        self.g = {}
+        self.rhs = {goal: 0}
+
+        # the priority queue of inconsistent states (g != rhs), with lazily deleted entries: an entry is only valid if its key
+        # is still the one recorded for the state in '_queued'
+        self._heap = []
+        self._queued = {}
+
+        self.start = None
+        self.km = 0
+
+        # the number of states expanded by the last call to route()
+        self.expanded = 0
+
+        self._push(goal)
+
+    # the heuristic cost between the current start state and state 's'
+    def _heuristic(self, s):
+        if self._unit_cost == 0:
+            return 0
+        return self._unit_cost * self.nav._distance(self.start, s)
+
+    def _key(self, s):
+        k = min(self.g.get(s, inf), self.rhs.get(s, inf))
+        return (k + self._heuristic(s) + self.km, k)
+
+    # queue state 's' with its current key (states changed before the first route are only keyed once the start state is known)
+    def _push(self, s):
+        if self.start is None:
+            self._queued[s] = None
+            return
+        key = self._key(s)
+        self._queued[s] = key
+        heapq.heappush(self._heap, (key, s))
+
+    # the smallest valid key in the queue, dropping stale entries
+    def _top(self):
+        heap = self._heap
+        while heap:
+            key, s = heap[0]
+            if self._queued.get(s) == key:
+                return key, s
+            heapq.heappop(heap)
+        return (inf, inf), None
+
+    # recompute the cost of state 's' from its successors, and queue it if it became inconsistent
+    def _update_state(self, s):
+        if s != self.goal:
+            self.rhs[s] = self._best_edge(s)[1]
+
+        if self.g.get(s, inf) != self.rhs.get(s, inf):
+            self._push(s)
+        else:
+            self._queued.pop(s, None)
+
+    # the cheapest edge out of state 's' based on the successors' costs, as (edge, cost), or (-1, inf) if there is none
+    def _best_edge(self, s):
+        graph = self.nav.graph
+        g = self.g
+        best = -1
+        best_w = inf
+        for e in range(graph.first[s], graph.first[s + 1]):
+            w = self.nav.edge_cost(e) + g.get(graph.target[e], inf)
+            if w < best_w:
+                best = e
+                best_w = w
+        return best, best_w
+
+    # update the predecessors of state 's'
+    def _update_predecessors(self, s):
+        source = self.nav.graph.source
+        in_edges = self._in_edges
+        for i in range(self._in_first[s], self._in_first[s + 1]):
+            self._update_state(source[in_edges[i]])
+
+    # mark the edges of the navigator's graph in 'edges' as changed (blocked, unblocked or given a new cost)
+    def update(self, edges):
+        source = self.nav.graph.source
+        for e in edges:
+            self._update_state(source[e])
+
+    # expand states until the cost from the start state is final
+    def _compute(self):
+        g = self.g
+        rhs = self.rhs
+        expanded = 0
+        while True:
+            key, u = self._top()
+            start_key = self._key(self.start)
+            if u is None or (key >= start_key and rhs.get(self.start, inf) == g.get(self.start, inf)):
+                break
+
+            expanded += 1
+            new_key = self._key(u)
+            if key < new_key:
+                # the key is out of date since the start state moved, so queue it again with the right key
+                self._push(u)
+            elif g.get(u, inf) > rhs.get(u, inf):
+                # the cost went down: it is final, and the predecessors may now be cheaper
+                g[u] = rhs[u]
+                del self._queued[u]
+                self._update_predecessors(u)
+            else:
+                # the cost went up: forget it, and recompute it and the predecessors from their successors
+                g.pop(u, None)
+                self._update_state(u)
+                self._update_predecessors(u)
+        self.expanded = expanded
+
+    # the lowest cost list of transitions from state 's' to the goal, or None if the goal cannot be reached
+    def route(self, s):
+        if self.start is None:
+            self.start = s
+            for u in list(self._queued):
+                self._push(u)
+        elif s != self.start:
+            self.km += self._heuristic(s)
+            self.start = s
+        self._compute()
+
+        if self.g.get(s, inf) == inf:
+            return None
+
+        # follow the cheapest successor from each state
+        graph = self.nav.graph
+        route = []
+        while s != self.goal:
+            e = self._best_edge(s)[0]
+            if e < 0 or len(route) > len(self.g):
+                return None
+            route.append(self.nav.transitions[graph.transition[e]])
+            s = graph.target[e]
+        return route
@@ -0,0 +1,204 @@
+import heapq
+import hashlib
+import struct
+from array import array
+from math import inf, isnan, nan
+
+
+# a precomputed table of the next transition and the total cost between every pair of states
+# route queries become simple lookups that take time proportional to the length of the route instead of a full search
+class RouteTable:
+    # identifies route cache files, and is changed whenever the file format changes
+    MAGIC = b'EV3RT2'
+
+    def __init__(self, key, states, next_hop, dist, durations=None, samples=None):
+        # hash of the transition list the table was built from (its states and actions, not its costs)
+        self.key = key
+
+        # the states covered by the table, and the index of each state in the table rows/columns
+        self.states = states
+        self.index = {s: i for i, s in enumerate(states)}
+
+        # next_hop[i * n + j] is the index (in the navigator's transition list) of the first transition on the route from state i to state j, or -1 if there is no route
+        # dist[i * n + j] is the total cost of that route
+        self.next_hop = next_hop
+        self.dist = dist
+
+        # the measured duration of each transition the table was built with (NaN if it was not measured yet), and the number of
+        # measurements behind it, so the costs learned before a restart are restored along with the table
+        self.durations = durations
+        self.samples = samples
+
+        # set by attach() to the transition list the indices in 'next_hop' refer to
+        self.transitions = None
+
+    # generate a hash of a navigator's transitions so a cached table is only reused for the same layout
+    # the costs are left out: they are stored with the table and checked separately, since the measured durations they come from
+    # are only known again after the table restores them
+    @staticmethod
+    def layout_key(nav):
+        h = hashlib.sha1()
+        for t in nav.transitions:
+            h.update('{},{},{};'.format(int(t.s0), int(t.s), int(t.action)).encode('utf-8'))
+        return h.hexdigest()
+
+    # the measured durations and sample counts of a navigator's transitions, in the form they are stored in
+    @staticmethod
+    def measurements(nav):
+        durations = array('d', [nan if t.duration is None else t.duration for t in nav.transitions])
+        samples = array('i', [t.samples for t in nav.transitions])
+        return durations, samples
+
+    # whether the table was built with the navigator's current transition costs
+    def matches(self, nav):
+        durations = self.measurements(nav)[0]
+        return all(a == b or (isnan(a) and isnan(b)) for a, b in zip(durations, self.durations))
+
+    # compute the tables by running a Dijkstra search from every state
+    @classmethod
+    def build(cls, nav):
+        states = set([nav.state])
+        for t in nav.transitions:
+            states.add(t.s0)
+            states.add(t.s)
+        states = sorted(states)
+        index = {s: i for i, s in enumerate(states)}
+        n = len(states)
+
+        # the searches run over the navigator's compact graph (including blocked edges), which also gives the position of each
+        # transition in the navigator's transition list so it can be stored as an integer
+        graph = nav.graph
+
+        next_hop = array('i', [-1]) * (n * n)
+        dist = array('d', [inf]) * (n * n)
+
+        for i, s_start in enumerate(states):
+            row = i * n
+            dist[row + i] = 0
+
+            # 'first' stores the first transition taken from 's_start' on the best route found to each state
+            first = {s_start: -1}
+            weights = {s_start: 0}
+            visited = set()
+            counter = 0
+            heap = [(0, counter, s_start)]
+
+            while heap:
+                s0_w, _, s0 = heapq.heappop(heap)
+                if s0 in visited:
+                    continue
+                visited.add(s0)
+
+                j = row + index[s0]
+                dist[j] = s0_w
+                next_hop[j] = first[s0]
+
+                for e in range(graph.first[s0], graph.first[s0 + 1]):
+                    s = graph.target[e]
+                    if s not in visited:
+                        w = s0_w + graph.cost[e]
+                        if w < weights.get(s, inf):
+                            weights[s] = w
+                            # leaving the start state, the first transition is the transition itself, otherwise it is inherited
+                            first[s] = graph.transition[e] if s0 == s_start else first[s0]
+                            counter += 1
+                            heapq.heappush(heap, (w, counter, s))
+
+        durations, samples = cls.measurements(nav)
+        table = cls(cls.layout_key(nav), states, next_hop, dist, durations, samples)
+        table.attach(nav)
+        return table
+
+    # load the table from 'path' if it was built for the navigator's current transitions, otherwise build it (and save it to 'path')
+    # transitions the navigator has not measured yet (such as after a restart) take the durations stored with the table
+    @classmethod
+    def load_or_build(cls, nav, path=None):
+        if path is not None:
+            table = cls.load(path)
+            if table is not None and table.key == cls.layout_key(nav):
+                nav.restore_durations(table.durations, table.samples)
+                if table.matches(nav):
+                    table.attach(nav)
+                    return table
+
+        table = cls.build(nav)
+        if path is not None:
+            try:
+                table.save(path)
+            except OSError as e:
+                print('Could not save route table: {}'.format(e))
+        return table
+
+    # link the table to the navigator's transition list
+    def attach(self, nav):
+        self.transitions = nav.transitions
+
+    # write the table to a compact binary file
+    def save(self, path):
+        n = len(self.states)
+        states = array('i', [int(s) for s in self.states])
+        with open(path, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(self.key.encode('ascii'))
+            f.write(struct.pack('<I', n))
+            states.tofile(f)
+            self.next_hop.tofile(f)
+            self.dist.tofile(f)
+            f.write(struct.pack('<I', len(self.durations)))
+            self.durations.tofile(f)
+            self.samples.tofile(f)
+
+    # read a table written by save(), returns None if the file is missing or not a valid route table
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'rb') as f:
+                if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                    return None
+                key = f.read(40).decode('ascii')
+                n, = struct.unpack('<I', f.read(4))
+
+                states = array('i')
+                states.fromfile(f, n)
+                next_hop = array('i')
+                next_hop.fromfile(f, n * n)
+                dist = array('d')
+                dist.fromfile(f, n * n)
+
+                m, = struct.unpack('<I', f.read(4))
+                durations = array('d')
+                durations.fromfile(f, m)
+                samples = array('i')
+                samples.fromfile(f, m)
+        except (OSError, EOFError, struct.error, UnicodeDecodeError):
+            return None
+
+        return cls(key, list(states), next_hop, dist, durations, samples)
+
+    # the total cost of the route between two states (inf if there is no route)
+    def cost(self, s0, s):
+        i = self.index.get(s0)
+        j = self.index.get(s)
+        if i is None or j is None:
+            return inf
+        return self.dist[i * len(self.states) + j]
+
+    # the list of transitions leading from state 's0' to state 's', or None if there is no route
+    def route(self, s0, s):
+        if s0 == s:
+            return []
+
+        n = len(self.states)
+        j = self.index.get(s)
+        if j is None or s0 not in self.index:
+            return None
+
+        route = []
+        while s0 != s:
+            k = self.next_hop[self.index[s0] * n + j]
+            if k < 0:
+                return None
+            t = self.transitions[k]
+            route.append(t)
+            s0 = t.s
+        return route
@@ -0,0 +1,440 @@
+import os
+import sys
+import time
+import random
+import argparse
+from math import sin, cos, atan2, hypot, pi
+
+from navigation import *
+from jobs import Job
+from control import ColorReader
+
+
+# physical dimensions of the simulated robot and layout (meters)
+SPACING_X = 0.8         # distance between avenues (grid x units)
+SPACING_Y = 0.35        # distance between rows (grid y units)
+LINE_WIDTH = 0.02       # width of the tape lines
+DOT_RADIUS = 0.025      # radius of the mark at each intersection and at the end of each slot
+STUB_LENGTH = 0.28      # length of the dead-end lines leading to slots and stations
+WHEEL_CIRCUMFERENCE = 0.176
+TRACK = 0.12            # distance between the wheels
+SENSOR_OFFSET = 0.095   # distance of the color sensor in front of the axle
+CHANNEL_OFFSET = 0.012  # sideways distance of the green (left) and blue (right) channels from the center of the sensor
+SPOT_RADIUS = 0.006     # radius of the area seen by each channel
+
+# raw color sensor readings (r, g, b) over the white floor and over the tape
+RAW_WHITE = (280, 300, 260)
+RAW_BLACK = (30, 35, 30)
+
+# virtual time taken by each sensor read, which paces the polling loops of the motion code
+READ_TIME = 0.005
+
+# the largest physics step
+STEP_TIME = 0.005
+
+# unit vectors for the headings in state names
+HEADINGS = {'n': (0, 1), 'e': (1, 0), 's': (0, -1), 'w': (-1, 0)}
+
+
+# raised when a simulation runs past its deadline
+class SimTimeout(Exception):
+    pass
+
+
+# a virtual clock with the same interface as the 'time' module, advancing only as the simulation runs
+class SimClock:
+    def __init__(self, world):
+        self.world = world
+
+    def time(self):
+        return self.world.time
+
+    def sleep(self, seconds):
+        self.world.advance(seconds)
+
+
+# a motor with the parts of the ev3dev2 motor interface used by the robot
+# the speed follows the commanded speed with a first-order lag, and the position is counted in degrees
+class SimMotor:
+    def __init__(self, world, max_speed, lag=0.03):
+        self.world = world
+        self.max_speed = max_speed
+        self.lag = lag
+
+        self.position = 0
+        self.speed = 0
+        self.target_speed = 0
+
+        # target position for on_for_rotations (None when running forever or stopped)
+        self.target_position = None
+
+    @property
+    def is_running(self):
+        return self.target_speed != 0
+
+    def on(self, speed, brake=True, block=False):
+        self.target_position = None
+        self.target_speed = speed / 100 * self.max_speed
+
+    def off(self, brake=True):
+        self.target_position = None
+        self.target_speed = 0
+        if brake:
+            self.speed = 0
+
+    def on_for_rotations(self, speed, rotations, brake=True, block=True):
+        self.on_for_degrees(speed, rotations * 360, brake, block)
+
+    def on_for_degrees(self, speed, degrees, brake=True, block=True):
+        # like ev3dev2, the direction is the sign of the speed times the sign of the distance
+        if speed < 0:
+            degrees = -degrees
+        self.target_position = self.position + degrees
+        self.target_speed = abs(speed) / 100 * self.max_speed * (1 if degrees >= 0 else -1)
+        if block:
+            self.wait_until_not_moving()
+
+    # like ev3dev2, 'timeout' is in milliseconds, and returns False if the motor was still moving when it passed
+    def wait_until_not_moving(self, timeout=None):
+        return self.world.run_until(lambda: not self.is_running, None if timeout is None else timeout / 1000)
+
+    # advance the motor by 'dt' seconds
+    def step(self, dt):
+        self.speed += (self.target_speed - self.speed) * min(1, dt / self.lag)
+        self.position += self.speed * dt
+
+        # stop when the target position is reached
+        if self.target_position is not None and (self.position - self.target_position) * self.target_speed >= 0:
+            self.position = self.target_position
+            self.off()
+
+
+# the color sensor, reading the lines of the world under its green and blue channels
+class SimColorSensor:
+    MODE_RGB_RAW = 'RGB-RAW'
+
+    def __init__(self, world, noise=3):
+        self.world = world
+        self.noise = noise
+        self.mode = self.MODE_RGB_RAW
+        self.red_max, self.green_max, self.blue_max = 300, 300, 300
+
+    @property
+    def raw(self):
+        self.world.advance(READ_TIME)
+        center, left, right = self.world.sensor_points()
+        return (self._raw(0, center), self._raw(1, left), self._raw(2, right))
+
+    @property
+    def rgb(self):
+        r, g, b = self.raw
+        return (min(int(r * 255 / self.red_max), 255),
+                min(int(g * 255 / self.green_max), 255),
+                min(int(b * 255 / self.blue_max), 255))
+
+    def calibrate_white(self):
+        self.red_max, self.green_max, self.blue_max = self.raw
+
+    # the raw reading of one color at a point on the floor
+    def _raw(self, i, point):
+        coverage = self.world.coverage(point)
+        value = RAW_WHITE[i] + (RAW_BLACK[i] - RAW_WHITE[i]) * coverage
+        return max(0, int(value + self.world.random.gauss(0, self.noise)))
+
+
+# the IR sensor, seeing the lift come closer as it is raised
+class SimInfraredSensor:
+    MODE_IR_PROX = 'IR-PROX'
+
+    def __init__(self, world):
+        self.world = world
+        self.mode = self.MODE_IR_PROX
+
+    @property
+    def proximity(self):
+        self.world.advance(READ_TIME)
+
+        # 100 with the lift down (position 0), falling to 40 at 270 degrees up (negative positions)
+        lift = -self.world.motor_lift.position
+        return int(max(40, min(100, 100 - max(0, lift - 90) / 3)))
+
+
+class SimLeds:
+    def set_color(self, group, color):
+        pass
+
+
+# the simulated floor (lines drawn from a navigator's layout) and the robot driving on it
+class SimWorld:
+    def __init__(self, nav, state, seed=0):
+        self.nav = nav
+        self.time = 0
+        self.deadline = None
+        self.random = random.Random(seed)
+
+        self.motor_left = SimMotor(self, 1050)
+        self.motor_right = SimMotor(self, 1050)
+        self.motor_lift = SimMotor(self, 1560)
+        self.motor_lift.position = -30
+
+        self._build_lines()
+
+        # place the robot at the starting state
+        self.x, self.y, self.theta = self.pose(state)
+
+    # the position (meters) of the intersection of a state
+    def point(self, s):
+        x, y = self.nav.layout.positions[s]
+        return (x * SPACING_X, y * SPACING_Y)
+
+    # the direction a state faces, from its forward transition or from the heading at the end of its name
+    def heading(self, s):
+        for t in self.nav.possible_transitions(s, include_blocked=True):
+            if t.action == ActionType.forward:
+                (x0, y0), (x, y) = self.point(t.s0), self.point(t.s)
+                return atan2(y - y0, x - x0)
+        dx, dy = HEADINGS[self.nav.layout.name(s).rsplit('_', 1)[1]]
+        return atan2(dy, dx)
+
+    # the pose (x, y, theta) of the robot when it is at a state
+    def pose(self, s):
+        x, y = self.point(s)
+        return (x, y, self.heading(s))
+
+    # how far the robot is from the pose of a state (position error in meters, heading error in radians)
+    def error(self, s):
+        x, y, theta = self.pose(s)
+        dtheta = (self.theta - theta + pi) % (2 * pi) - pi
+        return hypot(self.x - x, self.y - y), abs(dtheta)
+
+    # draw the lines of the layout: a line for each forward transition, a dead-end line for each turn onto a heading
+    # without one, and a dot at every intersection and at the end of every dead-end line
+    def _build_lines(self):
+        self.segments = []
+        self.dots = []
+        directions = set()
+
+        for t in self.nav.transitions:
+            if t.action == ActionType.forward:
+                p0, p = self.point(t.s0), self.point(t.s)
+                self.segments.append((p0, p))
+                self.dots.append(p0)
+                self.dots.append(p)
+                directions.add((p0, round(atan2(p[1] - p0[1], p[0] - p0[0]), 2)))
+                directions.add((p, round(atan2(p0[1] - p[1], p0[0] - p[0]), 2)))
+
+        for t in self.nav.transitions:
+            if t.action != ActionType.forward:
+                p0 = self.point(t.s)
+                theta = self.heading(t.s)
+                if (p0, round(theta, 2)) not in directions:
+                    directions.add((p0, round(theta, 2)))
+                    p = (p0[0] + STUB_LENGTH * cos(theta), p0[1] + STUB_LENGTH * sin(theta))
+                    self.segments.append((p0, p))
+                    self.dots.append(p0)
+                    self.dots.append(p)
+
+        # index the shapes in a coarse grid so only nearby shapes are checked for each sensor reading
+        self.cell = 0.1
+        self.cells = {}
+        margin = max(DOT_RADIUS, LINE_WIDTH) + SPOT_RADIUS
+        for shape in [('segment', s) for s in self.segments] + [('dot', d) for d in set(self.dots)]:
+            if shape[0] == 'segment':
+                (x0, y0), (x1, y1) = shape[1]
+            else:
+                (x0, y0), (x1, y1) = shape[1], shape[1]
+            for i in range(int((min(x0, x1) - margin) // self.cell), int((max(x0, x1) + margin) // self.cell) + 1):
+                for j in range(int((min(y0, y1) - margin) // self.cell), int((max(y0, y1) + margin) // self.cell) + 1):
+                    self.cells.setdefault((i, j), []).append(shape)
+
+    # the fraction (0-1) of a channel's spot covered by a line, at a point on the floor
+    def coverage(self, point):
+        px, py = point
+        edge = 1
+        for kind, shape in self.cells.get((int(px // self.cell), int(py // self.cell)), []):
+            if kind == 'dot':
+                d = hypot(px - shape[0], py - shape[1]) - DOT_RADIUS
+            else:
+                (x0, y0), (x1, y1) = shape
+                dx, dy = x1 - x0, y1 - y0
+                u = max(0, min(1, ((px - x0) * dx + (py - y0) * dy) / (dx * dx + dy * dy)))
+                d = hypot(px - x0 - u * dx, py - y0 - u * dy) - LINE_WIDTH / 2
+            edge = min(edge, d)
+        return max(0, min(1, 0.5 - edge / (2 * SPOT_RADIUS)))
+
+    # the positions of the center, green (left) and blue (right) channels of the color sensor
+    def sensor_points(self):
+        c, s = cos(self.theta), sin(self.theta)
+        x = self.x + SENSOR_OFFSET * c
+        y = self.y + SENSOR_OFFSET * s
+        return ((x, y),
+                (x - CHANNEL_OFFSET * s, y + CHANNEL_OFFSET * c),
+                (x + CHANNEL_OFFSET * s, y - CHANNEL_OFFSET * c))
+
+    # run the simulation for 'dt' seconds of virtual time
+    def advance(self, dt):
+        while dt > 1e-12:
+            step = min(dt, STEP_TIME)
+            self._step(step)
+            dt -= step
+
+    # run the simulation until 'condition' returns True (or 'timeout' seconds have passed), returning whether it did
+    def run_until(self, condition, timeout=None):
+        end = None if timeout is None else self.time + timeout
+        while not condition():
+            if end is not None and self.time >= end:
+                return False
+            self._step(STEP_TIME)
+        return True
+
+    def _step(self, dt):
+        for m in (self.motor_left, self.motor_right, self.motor_lift):
+            m.step(dt)
+
+        # the drive motors are mounted backwards, so negative speeds drive the robot forward
+        v_left = -self.motor_left.speed / 360 * WHEEL_CIRCUMFERENCE
+        v_right = -self.motor_right.speed / 360 * WHEEL_CIRCUMFERENCE
+        v = (v_left + v_right) / 2
+        omega = (v_right - v_left) / TRACK
+
+        self.theta += omega * dt
+        self.x += v * cos(self.theta) * dt
+        self.y += v * sin(self.theta) * dt
+        self.time += dt
+
+        # stop runaway simulations, such as a robot that lost its line and will never find another intersection
+        if self.deadline is not None and self.time > self.deadline:
+            raise SimTimeout('Simulation passed its deadline at {:.1f}s'.format(self.time))
+
+
+# the simulated motors, sensors, LEDs and clock, with the same attributes as EV3Hardware
+class SimHardware:
+    def __init__(self, nav, state, seed=0):
+        self.world = SimWorld(nav, state, seed)
+        self.clock = SimClock(self.world)
+        self.leds = SimLeds()
+        self.motor_left = self.world.motor_left
+        self.motor_right = self.world.motor_right
+        self.motor_lift = self.world.motor_lift
+        self.sensor_color = SimColorSensor(self.world)
+        self.sensor_infrared = SimInfraredSensor(self.world)
+
+    # the simulated sensor has no sysfs files, so its channels are read through ColorSensor.rgb
+    def color_reader(self):
+        return ColorReader(self.sensor_color)
+
+
+# silences the prints of the motion code, which are only useful when watching a single run
+class Quiet:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+
+    def __enter__(self):
+        if self.enabled:
+            self.stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            sys.stdout.close()
+            sys.stdout = self.stdout
+
+
+# run a list of (type, location) jobs on a simulated robot starting at the navigator's current state
+# returns the virtual time, final pose error and status of each job, and the total virtual and wall-clock time
+# 'job_timeout' is the virtual time after which a job is abandoned (when the robot has lost the line)
+# 'metrics_path' is a file to write the timing histograms of the run to
+# 'tuning_path' is a file of line follower parameters found by tune.py, and 'trace_dir' a directory to write the control loop traces to
+def simulate(nav, jobs, seed=0, quiet=True, job_timeout=600, metrics_path=None, tuning_path=None, trace_dir=None):
+    from motion import Driver
+
+    state = nav.state
+    hardware = SimHardware(nav, state, seed)
+    world = hardware.world
+
+    with Quiet(quiet):
+        driver = Driver(hardware, nav)
+    if tuning_path is not None:
+        driver.load_tuning(tuning_path)
+    driver.trace_dir = trace_dir
+
+    results = []
+    wall_start = time.time()
+    virtual_start = world.time
+    for job_type, location in jobs:
+        job = driver.jobs.put(job_type, state, location)
+        t0 = world.time
+        world.deadline = t0 + job_timeout
+        with Quiet(quiet):
+            try:
+                driver.run_queued()
+            except SimTimeout:
+                driver.jobs.finish(job, Job.FAILED)
+
+        position_error, heading_error = world.error(location)
+        results.append({
+            'type': job_type,
+            'location': nav.layout.name(location),
+            'status': job.status,
+            'time': world.time - t0,
+            'position_error': position_error,
+            'heading_error': heading_error,
+        })
+        state = location
+
+    if metrics_path is not None:
+        driver.metrics.write(metrics_path)
+
+    return {
+        'jobs': results,
+        'virtual_time': world.time - virtual_start,
+        'wall_time': time.time() - wall_start,
+        'control_loop': driver.control_loop.stats(),
+        'motor_writes': driver.drive_left.writes + driver.drive_right.writes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run pickup/drop jobs on a simulated robot')
+    parser.add_argument('--layout', help='layout file to load (the hackster.io map if not given)')
+    parser.add_argument('--random', type=int, default=0, help='run this many random pallet moves instead of the demo sequence')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--metrics', help='write the timing histograms of the run to this file')
+    parser.add_argument('--tuning', help='line follower parameters to use (a file written by tune.py)')
+    parser.add_argument('--traces', help='write the control loop trace of each job to this directory')
+    args = parser.parse_args()
+
+    if args.layout:
+        from layout import load_layout
+        layout = load_layout(args.layout)
+        nav = Navigator(layout.state('start'), layout)
+    else:
+        nav = Navigator(State.start)
+    state = nav.layout.state
+
+    if args.random:
+        rng = random.Random(args.seed)
+        slots = sorted(set(s for name, s in nav.layout.index.items() if name.startswith('slot_')))
+        jobs = []
+        for _ in range(args.random):
+            src, dst = rng.sample(slots, 2)
+            jobs += [('pickup', src), ('drop', dst)]
+    else:
+        # bring a pallet in and store it, then take it back out and return to the start
+        jobs = [('pickup', state('slot_in')), ('drop', state('slot_5')),
+                ('pickup', state('slot_5')), ('drop', state('slot_out')),
+                ('move', state('slot_in'))]
+
+    result = simulate(nav, jobs, args.seed, metrics_path=args.metrics, tuning_path=args.tuning, trace_dir=args.traces)
+    for r in result['jobs']:
+        print('{type:7} {location:10} {status:9} {time:6.1f}s  position error {position_error:.3f}m  heading error {heading_error:.2f}rad'.format(**r))
+
+    n = len(result['jobs'])
+    print('{} jobs in {:.1f}s of robot time ({:.0f} jobs/hour), simulated in {:.1f}s ({:.0f}x real time)'.format(
+        n, result['virtual_time'], n / result['virtual_time'] * 3600, result['wall_time'], result['virtual_time'] / result['wall_time']))
+    print('control loop: {ticks} ticks at {rate}Hz, {overruns} overruns, mean jitter {jitter_mean:.4f}s, max jitter {jitter_max:.4f}s'.format(**result['control_loop']))
+    print('drive motor writes: {} ({:.2f} per tick)'.format(result['motor_writes'], result['motor_writes'] / max(1, result['control_loop']['ticks'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import re
+from math import inf
+
+from calibration import CalibrationStore
+from planner import JobPlanner, Move
+
+
+# chooses the slots pallets are stored in, based on the route costs from the in and out stations and how often each item is picked
+#
+# putting a pallet away costs the round trip from 'slot_in' to its slot, and each pick costs the round trip from 'slot_out'
+# fast movers are given the free slots that are cheapest to pick from, and slow movers leave those free for them by taking slots
+# further back, in proportion to how many of the stored items are picked more often
+#
+# the occupancy only changes once a pickup or drop is done, so slots a queued drop is going to are reserved until then
+# if 'path' is given, the occupancy and pick counts are kept in that JSON file so they survive a restart
+class Slotting:
+    # 'slots' is the list of slot states (every 'slot_<number>' of the layout if not given)
+    def __init__(self, nav, slots=None, inbound='slot_in', outbound='slot_out', path=None):
+        self.nav = nav
+        self.costs = JobPlanner(nav)
+        self.inbound = nav.layout.state(inbound)
+        self.outbound = nav.layout.state(outbound)
+
+        if slots is None:
+            slots = set(s for name, s in nav.layout.index.items() if re.match(r'slot_\d+$', name))
+        self.slots = sorted(slots)
+
+        # the item stored in each occupied slot, the number of times each item has been picked, and the slots reserved by queued drops
+        self.contents = {}
+        self.picks = {}
+        self.reserved = set()
+
+        self.store_file = CalibrationStore(path) if path is not None else None
+        self.load()
+
+    # read the stored occupancy and pick counts (slots are stored by name, so the file does not depend on the state numbering)
+    def load(self):
+        data = self.store_file.load() if self.store_file is not None else None
+        if not data:
+            return
+        index = self.nav.layout.index
+        self.contents = dict((index[name], item) for name, item in data.get('contents', {}).items() if name in index)
+        self.picks = data.get('picks', {})
+
+    # write the occupancy and pick counts (if the Slotting has a file)
+    def save(self):
+        if self.store_file is not None:
+            name = self.nav.layout.name
+            self.store_file.save({'contents': dict((name(s), item) for s, item in self.contents.items()), 'picks': self.picks})
+
+    # the round trip cost of putting a pallet away in slot 's'
+    def put_cost(self, s):
+        return self.costs.cost(self.inbound, s) + self.costs.cost(s, self.inbound)
+
+    # the round trip cost of picking a pallet from slot 's'
+    def pick_cost(self, s):
+        return self.costs.cost(self.outbound, s) + self.costs.cost(s, self.outbound)
+
+    # the picks of an item relative to the average item (1 for items never seen before)
+    def frequency(self, item):
+        if not self.picks:
+            return 1
+        mean = sum(self.picks.values()) / len(self.picks)
+        return self.picks.get(item, mean) / mean if mean > 0 else 1
+
+    def free_slots(self):
+        return [s for s in self.slots if s not in self.contents and s not in self.reserved]
+
+    # record a pallet stored in slot 's'
+    def store(self, s, item=None):
+        self.contents[s] = item
+
+    # record a pallet taken out of slot 's' (and picked, if 'picked' is True), returning its item
+    def remove(self, s, picked=True):
+        item = self.contents.pop(s, None)
+        if picked and item is not None:
+            self.record_pick(item)
+        return item
+
+    def record_pick(self, item, count=1):
+        self.picks[item] = self.picks.get(item, 0) + count
+
+    # the expected travel cost of the current slot assignment: each item's pick cost weighted by its frequency
+    def expected_cost(self, contents=None):
+        if contents is None:
+            contents = self.contents
+        return sum(self.frequency(item) * self.pick_cost(s) for s, item in contents.items())
+
+    # the best free slot for a new pallet of 'item', or None if every slot is full
+    def best_slot(self, item=None):
+        free = [s for s in self.free_slots() if self.pick_cost(s) < inf and self.put_cost(s) < inf]
+        if not free:
+            return None
+
+        # the share of the stored items that are picked more often than this one decides how far back the pallet goes
+        f = self.frequency(item)
+        stored = [self.frequency(i) for i in self.contents.values()]
+        rank = sum(1 for g in stored if g > f) / len(stored) if stored else 0
+
+        free.sort(key=lambda s: (self.pick_cost(s), self.put_cost(s)))
+        return free[min(int(rank * len(free)), len(free) - 1)]
+
+    # propose pallet moves that lower the expected travel cost by more than they cost to make
+    # 'horizon' is how many times over the current pick frequencies the new assignment is expected to be used
+    # moves to free slots and swaps of two pallets (through a free slot) are chosen greedily, best first, up to 'max_moves' moves
+    # returns the list of Moves in the order to run them, and the expected saving (travel saved minus the cost of the moves)
+    def propose(self, horizon=10, max_moves=10):
+        contents = dict(self.contents)
+        moves = []
+        saving = 0
+
+        while len(moves) < max_moves:
+            best = None
+            best_gain = 0
+            free = [s for s in self.slots if s not in contents and s not in self.reserved and self.pick_cost(s) < inf]
+            occupied = sorted(contents)
+
+            for a in occupied:
+                fa = self.frequency(contents[a])
+
+                # move the pallet to a free slot
+                for b in free:
+                    gain = horizon * fa * (self.pick_cost(a) - self.pick_cost(b)) - self.costs.cost(a, b)
+                    if gain > best_gain:
+                        best, best_gain = [Move(a, b)], gain
+
+                # swap it with a slower pallet in a cheaper slot, parking one of them in a free slot on the way
+                if not free or len(moves) + 3 > max_moves:
+                    continue
+                for b in occupied:
+                    fb = self.frequency(contents[b])
+                    if fb >= fa or self.pick_cost(b) >= self.pick_cost(a):
+                        continue
+                    c = min(free, key=lambda c: self.costs.cost(b, c) + self.costs.cost(c, a))
+                    cost = self.costs.cost(b, c) + self.costs.cost(a, b) + self.costs.cost(c, a)
+                    gain = horizon * (fa - fb) * (self.pick_cost(a) - self.pick_cost(b)) - cost
+                    if gain > best_gain:
+                        best, best_gain = [Move(b, c), Move(a, b), Move(c, a)], gain
+
+            if best is None:
+                break
+
+            # apply the moves to the planned assignment, and look for the next improvement from there
+            for m in best:
+                contents[m.dst] = contents.pop(m.src)
+            moves += best
+            saving += best_gain
+
+        return moves, saving
@@ -0,0 +1,98 @@
+import sys
+import struct
+from array import array
+
+
+# flags recorded with each control loop tick
+FLAG_FORWARD = 1         # tick of the line follower (otherwise a tick of a turn)
+FLAG_INTERSECTION = 2    # the line follower entered an intersection on this tick
+FLAG_LINE = 4            # a turn reached the next line on this tick
+FLAG_MISSED = 8          # the line follower counted an intersection it should have found by now (see Odometry)
+FLAG_PHANTOM = 16        # the line follower ignored an intersection found long before the next one was due
+
+# the recorded columns and their array type codes
+COLUMNS = (
+    ('t', 'd'),          # clock time (seconds)
+    ('g', 'H'),          # green channel
+    ('b', 'H'),          # blue channel
+    ('error', 'f'),      # PID error
+    ('steering', 'f'),   # PID output
+    ('left', 'b'),       # left motor command (percent)
+    ('right', 'b'),      # right motor command (percent)
+    ('flags', 'B'),
+)
+
+# identifies trace files, and is changed whenever the file format changes
+MAGIC = b'EV3TR1'
+
+
+# a fixed-size ring buffer of control loop ticks
+# the columns are preallocated arrays, so recording a tick only overwrites values in place
+# once the buffer is full, the oldest ticks are overwritten
+class TraceBuffer:
+    def __init__(self, capacity=8192):
+        self.capacity = capacity
+        self.columns = [array(code, [0]) * capacity for _, code in COLUMNS]
+        self.t, self.g, self.b, self.error, self.steering, self.left, self.right, self.flags = self.columns
+        self.clear()
+
+    # forget all recorded ticks
+    def clear(self):
+        self.index = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    # record one tick
+    def record(self, t, g, b, error, steering, left, right, flags):
+        i = self.index
+        self.t[i] = t
+        self.g[i] = g
+        self.b[i] = b
+        self.error[i] = error
+        self.steering[i] = steering
+        self.left[i] = left
+        self.right[i] = right
+        self.flags[i] = flags
+
+        i += 1
+        self.index = 0 if i == self.capacity else i
+        if self.count < self.capacity:
+            self.count += 1
+
+    # the recorded values of a column in the order they were recorded
+    def column(self, name):
+        c = self.columns[[n for n, _ in COLUMNS].index(name)]
+        if self.count < self.capacity:
+            return c[:self.count]
+        return c[self.index:] + c[:self.index]
+
+    # write the recorded ticks to a binary file: a header, then each column as a packed little-endian array
+    def dump(self, path):
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', self.count))
+            for name, _ in COLUMNS:
+                values = self.column(name)
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                values.tofile(f)
+
+
+# read a trace file written by TraceBuffer.dump
+# returns a dictionary of column name -> array of values
+def load_trace(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a trace file'.format(path))
+        count, = struct.unpack('<I', f.read(4))
+
+        trace = {}
+        for name, code in COLUMNS:
+            values = array(code)
+            values.fromfile(f, count)
+            if sys.byteorder == 'big':
+                values.byteswap()
+            trace[name] = values
+        return trace
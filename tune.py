@@ -0,0 +1,427 @@
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+# NumPy is only needed by this offline tool, not on the robot
+import numpy as np
+
+from telemetry import load_trace, FLAG_FORWARD, FLAG_INTERSECTION, FLAG_LINE
+from sim import WHEEL_CIRCUMFERENCE, TRACK, SENSOR_OFFSET, CHANNEL_OFFSET, SPOT_RADIUS, LINE_WIDTH
+
+
+# the speed of the drive motors at 100% (degrees per second) and their response time (seconds), as in sim.py
+MOTOR_MAX_SPEED = 1050
+MOTOR_LAG = 0.03
+
+# the forward speed of the robot at 100% (meters per second)
+MAX_SPEED = MOTOR_MAX_SPEED / 360 * WHEEL_CIRCUMFERENCE
+
+# how fast the line follower changes speed (per second), as Driver.ramp_rate
+RAMP_RATE = 0.5
+
+# the sideways offset of the sensor from the line beyond which both channels see white and the line is lost (meters)
+LOST_OFFSET = CHANNEL_OFFSET + LINE_WIDTH / 2 + SPOT_RADIUS
+
+# the parameters used by the Driver before tuning
+DEFAULTS = {'kp': 1.5, 'kd': 2, 'cruise_speed': 0.45, 'intersection_threshold': 110, 'turn_thresholds': (220, 180)}
+
+# the disturbances each forward run is replayed with, as (heading error in radians, left/right wheel speed mismatch)
+# a stable controller has to recover from all of them
+DISTURBANCES = ((0, 0), (0.08, 0.03), (-0.08, -0.03))
+
+# how far an intersection may be detected from where it was detected in the recording (meters)
+INTERSECTION_TOLERANCE = 0.03
+
+# the largest RMS sideways offset over the second half of a run that still counts as settled on the line (meters)
+SETTLED_OFFSET = 0.003
+
+
+# the fraction (0-1) of a channel's spot covered by the line, 'd' meters from the center of the line (as in SimWorld.coverage)
+def coverage(d):
+    return np.clip(0.5 - (np.abs(d) - LINE_WIDTH / 2) / (2 * SPOT_RADIUS), 0, 1)
+
+
+# the readings of the color sensor channels around a plain line, fitted to the recorded readings
+#
+# the darkest readings of the line follower are the intersection marks (fully covered), and the readings while the robot is
+# centered on the line are the partly covered level the sensor geometry predicts for zero offset, which gives the white level
+class SensorModel:
+    def __init__(self, g, b):
+        centered = 1 - coverage(CHANNEL_OFFSET)
+        balanced = np.abs(g.astype(float) - b) <= 2
+        self.levels = []
+        for values in (g, b):
+            black = np.percentile(values, 1)
+            center = np.median(values[balanced]) if balanced.any() else np.median(values)
+            white = min(255, black + (center - black) / centered)
+            self.levels.append((white, black))
+
+        # the line follower error over the sideways offsets it rises steadily with (until one channel is fully on the line),
+        # to map recorded errors back to offsets
+        limit = CHANNEL_OFFSET - LINE_WIDTH / 2 + SPOT_RADIUS
+        self._offsets = np.linspace(-limit, limit, 201)
+        self._errors = self.error(self._offsets)
+
+    # the (green, blue) readings with the sensor 'y' meters left of the center of the line
+    # (the green channel is on the left)
+    def read(self, y):
+        (gw, gb), (bw, bb) = self.levels
+        return gw - (gw - gb) * coverage(y + CHANNEL_OFFSET), bw - (bw - bb) * coverage(y - CHANNEL_OFFSET)
+
+    # the line follower error (as computed by Driver.move_forward) with the sensor 'y' meters left of the line
+    def error(self, y):
+        g, b = self.read(y)
+        return (g - b) / 1000
+
+    # the sideways offsets that best explain the recorded readings
+    def offset(self, g, b):
+        return np.interp((g.astype(float) - b) / 1000, self._errors, self._offsets)
+
+
+# a line follower run of a recorded trace, replayed by distance along the line
+#
+# the recorded readings are split into what the plain line explains for the offset the robot had, and the rest: the intersection
+# marks, worn tape, lighting and sensor noise of that stretch of floor
+# a candidate's readings are its own offset's plain line readings plus the rest recorded at the same distance
+class ForwardRun:
+    def __init__(self, sensor, t, g, b, left, right, flags):
+        # the line follower slows its loop down in the middle of segments, so ticks are not evenly spaced: the run is replayed at
+        # the full rate it runs at near intersections
+        ticks = np.diff(t)
+        self.dt = float(ticks.min()) if len(t) > 1 else 0.01
+
+        # the distance driven at each tick, from the recorded motor commands (the motors are mounted backwards)
+        # the speeds at the start and the end of the run are the speed the line follower was asked for
+        speed = -(left.astype(float) + right) / 200
+        self.x = np.concatenate(([0], np.cumsum(speed[:-1] * MAX_SPEED * ticks)))
+        self.length = self.x[-1]
+        self.start_speed = round(speed[0], 2)
+        self.end_speed = round(speed[-1], 2)
+
+        y = sensor.offset(g, b)
+        g_line, b_line = sensor.read(y)
+        self.g_rest = g - g_line
+        self.b_rest = b - b_line
+        self.start_offset = y[0]
+
+        # where the intersections were detected
+        self.intersections = self.x[(flags & FLAG_INTERSECTION) != 0]
+
+
+# a turn of a recorded trace, with the readings of the outside channel and the ticks the next line was detected at
+class TurnRun:
+    def __init__(self, light, flags):
+        self.light = light.astype(float)
+        self.lines = np.nonzero((flags & FLAG_LINE) != 0)[0]
+
+
+# split a trace into its forward runs and turns
+def split_trace(trace, sensor):
+    t = np.asarray(trace['t'])
+    g = np.asarray(trace['g'])
+    b = np.asarray(trace['b'])
+    left = np.asarray(trace['left'])
+    right = np.asarray(trace['right'])
+    flags = np.asarray(trace['flags'])
+    if len(t) == 0:
+        return [], []
+
+    # a run ends where the kind of tick (or the direction of a turn) changes, or where ticks are missing (such as rolling past an intersection)
+    forward = (flags & FLAG_FORWARD) != 0
+    kind = np.where(forward, 0, np.where(left < 0, 1, 2))
+    dt = np.median(np.diff(t)) if len(t) > 1 else 0.01
+    breaks = np.nonzero((kind[1:] != kind[:-1]) | (np.diff(t) > 3 * dt))[0] + 1
+
+    forward_runs = []
+    turns = []
+    for i, j in zip(np.concatenate(([0], breaks)), np.concatenate((breaks, [len(t)]))):
+        if j - i < 2:
+            continue
+        if kind[i] == 0:
+            forward_runs.append(ForwardRun(sensor, t[i:j], g[i:j], b[i:j], left[i:j], right[i:j], flags[i:j]))
+        elif (flags[i:j] & FLAG_LINE).any():
+            # the outside channel of a right turn (left motor forward) is green, and of a left turn blue
+            turns.append(TurnRun(g[i:j] if kind[i] == 1 else b[i:j], flags[i:j]))
+    return forward_runs, turns
+
+
+# read the traces in 'paths' (files, or directories of .trace files)
+def load_traces(paths):
+    traces = []
+    for path in paths:
+        if os.path.isdir(path):
+            traces += [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.trace')]
+        else:
+            traces.append(path)
+    return [load_trace(path) for path in traces]
+
+
+# the sensor model and the runs of a list of traces
+def prepare(traces):
+    forward = np.concatenate([(np.asarray(tr['flags']) & FLAG_FORWARD) != 0 for tr in traces])
+    g = np.concatenate([np.asarray(tr['g']) for tr in traces])[forward]
+    b = np.concatenate([np.asarray(tr['b']) for tr in traces])[forward]
+    sensor = SensorModel(g, b)
+
+    forward_runs = []
+    turns = []
+    for trace in traces:
+        f, t = split_trace(trace, sensor)
+        forward_runs += f
+        turns += t
+    return sensor, forward_runs, turns
+
+
+# replay a forward run with the candidate parameters in the columns of 'params' (kp, kd, cruise speed, threshold), each under every disturbance
+# the control loop of Driver.move_forward runs on all the candidates at once, one tick at a time: like the recorded run, it starts at
+# the speed it was asked for and slows back down to it for the last intersection, but speeds up to the candidate's cruise speed in between
+# returns (ok, time, rms offset) arrays with a value per candidate and disturbance
+def replay_forward(sensor, run, params):
+    n = len(DISTURBANCES)
+    kp, kd, cruise, threshold = [np.repeat(p, n) for p in params]
+    heading_error = np.tile([d[0] for d in DISTURBANCES], len(params[0]))
+    mismatch = np.tile([d[1] for d in DISTURBANCES], len(params[0]))
+    lanes = len(kp)
+    dt = run.dt
+    expected = len(run.intersections)
+
+    theta = heading_error.copy()
+    axle = np.full(lanes, run.start_offset)
+    y = axle + SENSOR_OFFSET * np.sin(theta)
+    x = np.zeros(lanes)
+    e0 = np.zeros(lanes)
+    speed = np.full(lanes, run.start_speed)
+    speed_step = RAMP_RATE * dt
+    left = np.round(-speed * 100)
+    right = left.copy()
+    wheel_left = -left / 100 * MAX_SPEED
+    wheel_right = wheel_left.copy()
+    inside = np.zeros(lanes, bool)
+    count = np.zeros(lanes, int)
+    detected = np.full((lanes, max(1, expected)), np.nan)
+    arrival_speed = np.zeros(lanes)
+    active = np.ones(lanes, bool)
+    ok = np.ones(lanes, bool)
+    time = np.zeros(lanes)
+    square_sum = np.zeros(lanes)
+    settling = np.zeros(lanes)
+    alpha = 1 - np.exp(-dt / MOTOR_LAG)
+    lanes_index = np.arange(lanes)
+
+    # give up on candidates that have not found the last intersection well past where it was recorded, or that are far too slow
+    end = run.length + INTERSECTION_TOLERANCE
+    max_ticks = int(end / (min(run.start_speed, run.end_speed) * MAX_SPEED * 0.5) / dt) + 10
+
+    for _ in range(max_ticks):
+        if not active.any():
+            break
+
+        # read the sensor (rounded down to whole levels and clipped like the real readings)
+        g, b = sensor.read(y)
+        g = np.clip(np.floor(g + np.interp(x, run.x, run.g_rest)), 0, 255)
+        b = np.clip(np.floor(b + np.interp(x, run.x, run.b_rest)), 0, 255)
+
+        enter = active & ~inside & (g < threshold) & (b < threshold)
+        leave = active & inside & ~enter & (g > threshold) & (b > threshold)
+        follow = active & ~enter & ~leave
+
+        # count the intersections, and finish the run at the last one
+        if enter.any():
+            i = lanes_index[enter]
+            slot = count[i]
+            fits = slot < detected.shape[1]
+            detected[i[fits], slot[fits]] = x[i[fits]]
+            count[i] += 1
+            inside[i] = True
+            arrival_speed[i] = speed[i]
+        inside[leave] = False
+
+        # move the speed towards the cruise speed, or back to the end speed for the last intersection
+        target = np.where((count < expected - 1) & (cruise > run.end_speed), cruise, run.end_speed)
+        speed = np.where(follow, np.where(speed < target, np.minimum(speed + speed_step, target), np.maximum(speed - speed_step, target)), speed)
+
+        # steer by the PID controller (the other ticks keep the last motor speeds)
+        e = (g - b) / 1000
+        steering = kp * e + (e - e0) * kd
+        e0 = np.where(follow, e, e0)
+        left = np.where(follow, np.round(-np.clip(speed + steering, -1, 1) * 100), left)
+        right = np.where(follow, np.round(-np.clip(speed - steering, -1, 1) * 100), right)
+
+        done = active & (count >= expected) & (expected > 0)
+        active &= ~done
+
+        # move the robot: the wheels follow their commands with a lag, one of them slower or faster by the mismatch
+        wheel_left += (-left / 100 * MAX_SPEED * (1 + mismatch) - wheel_left) * alpha
+        wheel_right += (-right / 100 * MAX_SPEED * (1 - mismatch) - wheel_right) * alpha
+        v = (wheel_left + wheel_right) / 2
+        omega = (wheel_right - wheel_left) / TRACK
+        theta = np.where(active, theta + omega * dt, theta)
+        axle = np.where(active, axle + v * np.sin(theta) * dt, axle)
+        x = np.where(active, x + v * np.cos(theta) * dt, x)
+        y = axle + SENSOR_OFFSET * np.sin(theta)
+        time += np.where(active, dt, 0)
+
+        # track how well the robot stays on the line over the second half of the run
+        late = active & (x > run.length / 2)
+        square_sum += np.where(late, y * y, 0)
+        settling += late
+
+        lost = active & ((np.abs(y) > LOST_OFFSET) | (x > end))
+        ok &= ~lost
+        active &= ~lost
+
+    # the robot has to be back to the end speed by the last intersection, since it rolls past it and stops (or turns) from there
+    ok &= ~active
+    ok &= count == expected
+    ok &= arrival_speed <= run.end_speed + 0.01
+    if expected:
+        ok &= np.all(np.abs(detected - run.intersections) <= INTERSECTION_TOLERANCE, axis=1)
+    rms = np.sqrt(square_sum / np.maximum(settling, 1))
+    return ok, time, rms
+
+
+# the worker processes keep the sensor model and runs, so they are only sent once per process
+_model = None
+
+
+def _init_worker(model):
+    global _model
+    _model = model
+
+
+# replay every forward run with a chunk of candidates (a worker process task)
+# returns, per candidate, whether it was stable in every run and disturbance, its total time and its worst RMS offset
+def _evaluate(params):
+    sensor, runs = _model
+    candidates = len(params[0])
+    n = len(DISTURBANCES)
+    stable = np.ones(candidates, bool)
+    total_time = np.zeros(candidates)
+    worst_rms = np.zeros(candidates)
+    for run in runs:
+        ok, time, rms = replay_forward(sensor, run, params)
+        ok &= rms <= SETTLED_OFFSET
+        stable &= ok.reshape(candidates, n).all(axis=1)
+        total_time += time.reshape(candidates, n).mean(axis=1)
+        worst_rms = np.maximum(worst_rms, rms.reshape(candidates, n).max(axis=1))
+    return stable, total_time, worst_rms
+
+
+# sweep every combination of the parameter lists over the forward runs, spread over a pool of 'workers' processes
+# returns a list of result dictionaries, the fastest stable candidates first
+def sweep_forward(sensor, runs, kps, kds, cruise_speeds, thresholds, workers=None, chunk=256):
+    grid = np.array(list(product(kps, kds, cruise_speeds, thresholds)), dtype=float)
+    chunks = [tuple(grid[i:i + chunk].T) for i in range(0, len(grid), chunk)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=((sensor, runs),)) as pool:
+        results = list(pool.map(_evaluate, chunks))
+
+    stable = np.concatenate([r[0] for r in results])
+    total_time = np.concatenate([r[1] for r in results])
+    worst_rms = np.concatenate([r[2] for r in results])
+
+    # candidates within a tenth of a second of each other are equally fast, and the one staying closest to the line is preferred
+    order = sorted(range(len(grid)), key=lambda i: (not stable[i], round(total_time[i], 1), worst_rms[i]))
+    return [{
+        'kp': float(grid[i][0]),
+        'kd': float(grid[i][1]),
+        'cruise_speed': float(grid[i][2]),
+        'intersection_threshold': int(grid[i][3]),
+        'stable': bool(stable[i]),
+        'time': float(total_time[i]),
+        'rms_offset': float(worst_rms[i]),
+    } for i in order]
+
+
+# replay the turn detection of Driver.move_turn on the recorded turns for every (light, dark) threshold pair,
+# with the readings shifted up and down by increasing amounts
+# a pair is robust to a shift if it still finds every recorded line, no later than it was found (the recording stops there)
+# and at most 'early' ticks before
+# returns a list of ((light, dark), margin) with the largest shift each pair is robust to, the most robust first
+def sweep_turns(turns, lights, darks, shifts=range(0, 65, 5), early=3):
+    pairs = [(light, dark) for light in lights for dark in darks if dark < light]
+    light_threshold = np.array([p[0] for p in pairs], float)
+    dark_threshold = np.array([p[1] for p in pairs], float)
+    margin = np.full(len(pairs), -1)
+    still_robust = np.ones(len(pairs), bool)
+
+    for shift in shifts:
+        for turn in turns:
+            for sign in (1, -1):
+                waiting = np.zeros(len(pairs), bool)
+                count = np.zeros(len(pairs), int)
+                found = np.zeros(len(pairs), int)
+                for tick, value in enumerate(turn.light + sign * shift):
+                    # the state machine of move_turn: wait for the outside channel to go light, then for it to go dark on the next line
+                    detect = waiting & (value < dark_threshold)
+                    waiting = np.where(detect, False, waiting | (value > light_threshold))
+                    for k, line in enumerate(turn.lines):
+                        if line - early <= tick <= line:
+                            found += detect & (count == k)
+                    count += detect
+                still_robust &= (count == len(turn.lines)) & (found == len(turn.lines))
+        margin[still_robust] = shift
+
+    order = sorted(range(len(pairs)), key=lambda i: (-margin[i], abs(pairs[i][0] - DEFAULTS['turn_thresholds'][0]) + abs(pairs[i][1] - DEFAULTS['turn_thresholds'][1])))
+    return [(pairs[i], int(margin[i])) for i in order]
+
+
+# parse a comma separated list of numbers, or a START:STOP:STEP range
+def number_list(text):
+    if ':' in text:
+        start, stop, step = [float(v) for v in text.split(':')]
+        return list(np.round(np.arange(start, stop + step / 2, step), 6))
+    return [float(v) for v in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune the line follower by replaying recorded control loop traces')
+    parser.add_argument('traces', nargs='+', help='trace files, or directories of them (such as the traces directory of the robot)')
+    parser.add_argument('--kp', type=number_list, default=number_list('0.5:4:0.5'))
+    parser.add_argument('--kd', type=number_list, default=number_list('0:6:1'))
+    parser.add_argument('--cruise', type=number_list, default=number_list('0.45:1:0.05'), help='cruise speeds between intersections (0-1)')
+    parser.add_argument('--threshold', type=number_list, default=number_list('70:150:10'), help='intersection thresholds')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--top', type=int, default=10, help='number of candidates to print')
+    parser.add_argument('--output', help='write the best parameters to this JSON file (for Driver.load_tuning)')
+    args = parser.parse_args()
+
+    sensor, runs, turns = prepare(load_traces(args.traces))
+    print('{} forward runs ({} intersections) and {} turns, white/black levels green {:.0f}/{:.0f} blue {:.0f}/{:.0f}'.format(
+        len(runs), sum(len(r.intersections) for r in runs), len(turns),
+        sensor.levels[0][0], sensor.levels[0][1], sensor.levels[1][0], sensor.levels[1][1]), file=sys.stderr)
+    if not runs:
+        print('No line follower runs in the traces')
+        return
+
+    results = sweep_forward(sensor, runs, args.kp, args.kd, args.cruise, args.threshold, args.workers)
+    baseline = sweep_forward(sensor, runs, [DEFAULTS['kp']], [DEFAULTS['kd']], [DEFAULTS['cruise_speed']], [DEFAULTS['intersection_threshold']], 1)[0]
+
+    print('{:>6} {:>6} {:>6} {:>9} {:>7} {:>8} {:>9}'.format('kp', 'kd', 'cruise', 'threshold', 'stable', 'time s', 'rms mm'))
+    for r in [baseline] + results[:args.top]:
+        print('{kp:6.2f} {kd:6.2f} {cruise_speed:6.2f} {intersection_threshold:9d} {stable!s:>7} {time:8.2f} {:9.2f}{}'.format(
+            r['rms_offset'] * 1000, ' (current)' if r is baseline else '', **r))
+
+    best = results[0]
+    if not best['stable']:
+        print('No stable parameters found')
+        return
+
+    tuning = dict((key, best[key]) for key in ('kp', 'kd', 'cruise_speed', 'intersection_threshold'))
+    tuning['turn_thresholds'] = list(DEFAULTS['turn_thresholds'])
+    if turns:
+        (light, dark), margin = sweep_turns(turns, range(150, 255, 5), range(60, 250, 5))[0]
+        if margin >= 0:
+            tuning['turn_thresholds'] = [light, dark]
+            print('turn thresholds {}/{} (robust to readings {} levels off)'.format(light, dark, margin))
+
+    print('best: {}'.format(json.dumps(tuning)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(tuning, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()